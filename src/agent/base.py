@@ -8,9 +8,10 @@ from typing import Literal, Optional, Type, cast
 from uu import Error
 from uuid import UUID, uuid4
 
+import numpy as np
 import pytz
 from colorama import Fore
-from langchain.output_parsers import OutputFixingParser, PydanticOutputParser
+from langchain.output_parsers import PydanticOutputParser
 from langchain.schema import AIMessage, HumanMessage
 from pydantic import BaseModel
 
@@ -21,12 +22,17 @@ from src.utils.logging import agent_logger
 
 from ..event.base import Event, EventsManager, EventType, MessageEventSubtype
 from ..location.base import Location
-from ..memory.base import MemoryType, RelatedMemory, SingleMemory, get_relevant_memories
+from ..memory.base import (
+    MemoryStore,
+    MemoryType,
+    SingleMemory,
+    get_relevant_memories,
+)
 from ..tools.base import CustomTool, get_tools
 from ..tools.context import ToolContext
 from ..tools.name import ToolName
 from ..utils.colors import LogColor
-from ..utils.embeddings import get_embedding
+from ..utils.embeddings import get_embeddings
 from ..utils.formatting import print_to_console
 from ..utils.model_name import ChatModelName
 from ..utils.models import ChatModel
@@ -37,10 +43,11 @@ from ..utils.parameters import (
     PLAN_LENGTH,
     REFLECTION_MEMORY_COUNT,
 )
+from ..utils.parsing import RepairingOutputParser
 from ..utils.prompt import Prompter, PromptString
 from ..world.context import WorldContext
 from .executor import PlanExecutor, PlanExecutorResponse
-from .importance import ImportanceRatingResponse
+from .importance import get_importance_service
 from .message import (
     AgentMessage,
     LLMMessageResponse,
@@ -63,6 +70,7 @@ class Agent(BaseModel):
     last_checked_events: datetime
     last_summarized_activity: datetime
     memories: list[SingleMemory]
+    memory_store: MemoryStore = None
     plans: list[SinglePlan]
     authorized_tools: list[ToolName]
     world_id: UUID
@@ -73,9 +81,16 @@ class Agent(BaseModel):
     discord_bot_token: str = None
     react_response: LLMReactionResponse = None
     recent_activity: str = ""
+    # the memories recent_activity summarizes, newest first
+    summarized_memory_ids: list[UUID] = []
+    # set when a memory is added after recent_activity was summarized
+    activity_summary_dirty: bool = True
+    # reflection runs in the background, at most one at a time
+    reflection_task: Optional[asyncio.Task] = None
 
     class Config:
         allow_underscore_names = True
+        arbitrary_types_allowed = True
 
     def __init__(
         self,
@@ -123,6 +138,9 @@ class Agent(BaseModel):
             recent_activity=recent_activity,
         )
 
+        # keep the memories in a contiguous store for fast retrieval
+        self.memory_store = MemoryStore(self.memories)
+
         print("\n\nAGENT INITIALIZED --------------------------\n")
         print(self)
 
@@ -304,33 +322,76 @@ class Agent(BaseModel):
     def color(self) -> LogColor:
         return self.context.get_agent_color(self.id)
 
-    async def _add_memory(
+    async def _add_memories(
         self,
-        description: str,
-        created_at: datetime = datetime.now(),
+        descriptions: list[str],
+        created_at: Optional[list[datetime]] = None,
         type: MemoryType = MemoryType.OBSERVATION,
-        related_memory_ids: list[UUID] = [],
+        related_memory_ids: Optional[list[list[UUID]]] = None,
         log: bool = True,
-    ) -> SingleMemory:
-        memory = SingleMemory(
-            agent_id=self.id,
-            type=type,
-            description=description,
-            importance=await self._calculate_importance(description),
-            embedding=await get_embedding(description),
-            related_memory_ids=related_memory_ids,
-            created_at=created_at,
+        embeddings: Optional[list[Optional[np.ndarray]]] = None,
+    ) -> list[SingleMemory]:
+        """Adds several memories at once, embedding and rating them together.
+        Memories without a precomputed embedding are embedded in one request."""
+        if len(descriptions) == 0:
+            return []
+
+        if created_at is None:
+            created_at = [datetime.now()] * len(descriptions)
+        if related_memory_ids is None:
+            related_memory_ids = [[] for _ in descriptions]
+
+        async def embed() -> list[np.ndarray]:
+            if embeddings is None:
+                return await get_embeddings(descriptions)
+
+            # Only embed the memories that don't have an embedding yet
+            missing = [
+                index for index, embedding in enumerate(embeddings) if embedding is None
+            ]
+            fetched = await get_embeddings([descriptions[index] for index in missing])
+            filled = list(embeddings)
+            for index, embedding in zip(missing, fetched):
+                filled[index] = embedding
+            return filled
+
+        # Rate and embed every memory concurrently
+        importances, memory_embeddings = await asyncio.gather(
+            asyncio.gather(
+                *[
+                    self._calculate_importance(description)
+                    for description in descriptions
+                ]
+            ),
+            embed(),
         )
 
-        self.memories.append(memory)
+        memories = [
+            SingleMemory(
+                agent_id=self.id,
+                type=type,
+                description=descriptions[index],
+                importance=importances[index],
+                embedding=memory_embeddings[index],
+                related_memory_ids=related_memory_ids[index],
+                created_at=created_at[index],
+            )
+            for index in range(len(descriptions))
+        ]
 
-        # add to database
-        await (await get_database()).insert(Tables.Memories, memory.db_dict())
+        self.memory_store.extend(memories)
+        self.activity_summary_dirty = True
+
+        # add to database, in one transaction
+        await (await get_database()).insert(
+            Tables.Memories, [memory.db_dict() for memory in memories]
+        )
 
         if log:
-            self._log("New Memory", f"{memory}")
+            for memory in memories:
+                self._log("New Memory", f"{memory}")
 
-        return memory
+        return memories
 
     async def _update_agent_row(self):
         row = {
@@ -385,6 +446,34 @@ class Agent(BaseModel):
 
         return cumulative_importance > 500
 
+    async def _reflect_if_needed(self):
+        try:
+            if await self._should_reflect():
+                await self._reflect()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._log("Reflection Failed", f"{e}")
+
+    def _schedule_reflection(self):
+        """Starts a reflection off the agent's critical path, unless one is
+        already running"""
+        if self.reflection_task is not None and not self.reflection_task.done():
+            return
+
+        self.reflection_task = asyncio.create_task(self._reflect_if_needed())
+
+    async def stop(self):
+        """Cancels any reflection still running in the background"""
+        if self.reflection_task is None or self.reflection_task.done():
+            return
+
+        self.reflection_task.cancel()
+        try:
+            await self.reflection_task
+        except asyncio.CancelledError:
+            pass
+
     def _db_dict(self):
         return {
             "id": str(self.id),
@@ -400,13 +489,21 @@ class Agent(BaseModel):
         }
 
     async def _summarize_activity(self, k: int = 20) -> str:
-        recent_memories = sorted(
-            self.memories, key=lambda memory: memory.created_at, reverse=True
-        )[:k]
+        # No memories were added since the last summary
+        if not self.activity_summary_dirty and self.recent_activity:
+            return self.recent_activity
+
+        recent_memories = self.memory_store.most_recent(k)
 
         if len(recent_memories) == 0:
             return "I haven't done anything recently."
 
+        # The new memories didn't make it into the summarized window
+        summarized_memory_ids = [memory.id for memory in recent_memories]
+        if summarized_memory_ids == self.summarized_memory_ids and self.recent_activity:
+            self.activity_summary_dirty = False
+            return self.recent_activity
+
         summary_prompter = Prompter(
             PromptString.RECENT_ACTIIVITY,
             {
@@ -419,12 +516,21 @@ class Agent(BaseModel):
 
         low_temp_llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0)
 
-        response = await low_temp_llm.get_chat_completion(
-            summary_prompter.prompt,
-            loading_text="🤔 Summarizing recent activity...",
-        )
+        # memories added while this summary is being made mark it dirty again
+        self.activity_summary_dirty = False
+
+        try:
+            response = await low_temp_llm.get_chat_completion(
+                summary_prompter.prompt,
+                prompt_type=PromptString.RECENT_ACTIIVITY,
+                loading_text="🤔 Summarizing recent activity...",
+            )
+        except Exception:
+            self.activity_summary_dirty = True
+            raise
 
         self.recent_activity = response
+        self.summarized_memory_ids = summarized_memory_ids
 
         return response
 
@@ -433,36 +539,11 @@ class Agent(BaseModel):
         print_to_console(f"[{self.full_name}] {title}", self.color, description)
 
     async def _calculate_importance(self, memory_description: str) -> int:
-        # Set up a complex chat model
-        complex_llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0)
-
-        importance_parser = OutputFixingParser.from_llm(
-            parser=PydanticOutputParser(pydantic_object=ImportanceRatingResponse),
-            llm=complex_llm.defaultModel,
+        # Rated together with the memories other agents are adding right now
+        return await get_importance_service().rate(
+            self.full_name, self.private_bio, memory_description
         )
 
-        # make importance prompter
-        importance_prompter = Prompter(
-            PromptString.IMPORTANCE,
-            {
-                "full_name": self.full_name,
-                "private_bio": self.private_bio,
-                "memory_description": memory_description,
-                "format_instructions": importance_parser.get_format_instructions(),
-            },
-        )
-
-        response = await complex_llm.get_chat_completion(
-            importance_prompter.prompt,
-            loading_text="🤔 Calculating memory importance...",
-        )
-
-        parsed_response: ImportanceRatingResponse = importance_parser.parse(response)
-
-        rating = parsed_response.rating
-
-        return rating
-
     def _get_current_tools(self) -> list[CustomTool]:
         location_tools = self.location.available_tools
 
@@ -538,9 +619,9 @@ class Agent(BaseModel):
         chat_llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0)
 
         # Set up the parser
-        question_parser = OutputFixingParser.from_llm(
+        question_parser = RepairingOutputParser.from_llm(
             parser=PydanticOutputParser(pydantic_object=ReflectionQuestions),
-            llm=chat_llm.defaultModel,
+            llm=chat_llm,
         )
 
         # Create questions Prompter
@@ -557,16 +638,21 @@ class Agent(BaseModel):
         # Get the reflection questions
         response = await chat_llm.get_chat_completion(
             questions_prompter.prompt,
+            prompt_type=PromptString.REFLECTION_QUESTIONS,
             loading_text="🤔 Thinking about what to reflect on...",
         )
 
         # Parse the response into an object
-        parsed_questions_response: ReflectionQuestions = question_parser.parse(response)
+        parsed_questions_response: ReflectionQuestions = await question_parser.aparse(
+            response
+        )
 
-        # For each question in the parsed questions...
-        for question in parsed_questions_response.questions:
+        # Reflect on every question concurrently
+        async def reflect_on_question(question: str) -> list[tuple[str, list[UUID]]]:
             # Get the related memories
-            related_memories = await get_relevant_memories(question, self.memories, 20)
+            related_memories = await get_relevant_memories(
+                question, self.memory_store, 20
+            )
 
             # Format them into a string
             memory_strings = [
@@ -575,9 +661,9 @@ class Agent(BaseModel):
             ]
 
             # Make the reflection parser
-            reflection_parser = OutputFixingParser.from_llm(
+            reflection_parser = RepairingOutputParser.from_llm(
                 parser=PydanticOutputParser(pydantic_object=ReflectionResponse),
-                llm=chat_llm.defaultModel,
+                llm=chat_llm,
             )
 
             self._log("Reflecting on Question", f"{question}")
@@ -595,28 +681,51 @@ class Agent(BaseModel):
             # Get the reflection insights
             response = await chat_llm.get_chat_completion(
                 reflection_prompter.prompt,
+                prompt_type=PromptString.REFLECTION_INSIGHTS,
                 loading_text="🤔 Reflecting",
             )
 
             # Parse the response into an object
-            parsed_insights_response: ReflectionResponse = reflection_parser.parse(
-                response
+            parsed_insights_response: ReflectionResponse = (
+                await reflection_parser.aparse(response)
             )
 
-            # For each insight in the parsed insights...
-            for reflection_insight in parsed_insights_response.insights:
-                # Get the related memory ids
-                related_memory_ids = [
-                    related_memories[index - 1].id
-                    for index in reflection_insight.related_statements
-                ]
-
-                # Add a new memory
-                await self._add_memory(
-                    description=reflection_insight.insight,
-                    type=MemoryType.REFLECTION,
-                    related_memory_ids=related_memory_ids,
+            # Pair each insight with the ids of its related memories
+            return [
+                (
+                    reflection_insight.insight,
+                    [
+                        related_memories[index - 1].id
+                        for index in reflection_insight.related_statements
+                    ],
                 )
+                for reflection_insight in parsed_insights_response.insights
+            ]
+
+        results = await asyncio.gather(
+            *[
+                reflect_on_question(question)
+                for question in parsed_questions_response.questions
+            ],
+            return_exceptions=True,
+        )
+
+        # A question that fails doesn't lose the insights from the others
+        insights = []
+        for question, result in zip(parsed_questions_response.questions, results):
+            if isinstance(result, Exception):
+                self._log("Reflection Failed", f"{question}: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                insights += result
+
+        # Add the insights as new memories, all at once
+        await self._add_memories(
+            [description for description, _ in insights],
+            type=MemoryType.REFLECTION,
+            related_memory_ids=[memory_ids for _, memory_ids in insights],
+        )
 
         # Gossip to other agents
 
@@ -644,6 +753,7 @@ class Agent(BaseModel):
 
         response = await chat_llm.get_chat_completion(
             gossip_prompter.prompt,
+            prompt_type=PromptString.GOSSIP,
             loading_text="🤔 Creating gossip...",
         )
 
@@ -674,11 +784,11 @@ class Agent(BaseModel):
         low_temp_llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0, streaming=True)
 
         # Make the plan parser
-        plan_parser = OutputFixingParser.from_llm(
+        plan_parser = RepairingOutputParser.from_llm(
             parser=PydanticOutputParser(
                 pydantic_object=LLMPlanResponse,
             ),
-            llm=low_temp_llm.defaultModel,
+            llm=low_temp_llm,
         )
 
         # Get a summary of the recent activity
@@ -719,11 +829,12 @@ class Agent(BaseModel):
         # Get the plans
         response = await chat_llm.get_chat_completion(
             plan_prompter.prompt,
+            prompt_type=PromptString.MAKE_PLANS,
             loading_text="🤔 Making plans...",
         )
 
         # Parse the response into an object
-        parsed_plans_response: LLMPlanResponse = plan_parser.parse(response)
+        parsed_plans_response: LLMPlanResponse = await plan_parser.aparse(response)
 
         invalid_locations = [
             plan.location_name
@@ -747,11 +858,12 @@ class Agent(BaseModel):
                         content=f"Your response included the following invalid location_ids: {invalid_locations}. Please try again."
                     ),
                 ],
+                prompt_type=PromptString.MAKE_PLANS,
                 loading_text="🤔 Correcting plans...",
             )
 
             # Parse the response into an object
-            parsed_plans_response: LLMPlanResponse = plan_parser.parse(response)
+            parsed_plans_response: LLMPlanResponse = await plan_parser.aparse(response)
 
         # Delete existing plans
         self.plans = []
@@ -801,9 +913,9 @@ class Agent(BaseModel):
 
         # LLM call to decide how to react to new events
         # Make the reaction parser
-        reaction_parser = OutputFixingParser.from_llm(
+        reaction_parser = RepairingOutputParser.from_llm(
             parser=PydanticOutputParser(pydantic_object=LLMReactionResponse),
-            llm=ChatModel(temperature=0).defaultModel,
+            llm=ChatModel(temperature=0),
         )
 
         # Get a summary of the recent activity
@@ -839,11 +951,15 @@ class Agent(BaseModel):
         llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0)
         response = await llm.get_chat_completion(
             reaction_prompter.prompt,
+            prompt_type=PromptString.REACT,
+            until_json=True,
             loading_text="🤔 Deciding how to react...",
         )
 
         # parse the reaction response
-        parsed_reaction_response: LLMReactionResponse = reaction_parser.parse(response)
+        parsed_reaction_response: LLMReactionResponse = await reaction_parser.aparse(
+            response
+        )
 
         self._log(
             "Reaction",
@@ -875,7 +991,7 @@ class Agent(BaseModel):
             plan.related_message.get_event_message()
             if plan.related_message
             else plan.description,
-            memories=self.memories,
+            memories=self.memory_store,
             k=20,
         )
 
@@ -990,16 +1106,15 @@ class Agent(BaseModel):
         )
 
         if len(events) > 0:
-            # Make new memories based on the events
-            new_memories = [
-                await self._add_memory(
-                    event.description,
-                    created_at=event.timestamp,
-                    type=MemoryType.OBSERVATION,
-                    log=False,
-                )
-                for event in events
-            ]
+            # Make new memories based on the events. They reuse the embedding the
+            # world computed for each event, and are rated concurrently
+            new_memories = await self._add_memories(
+                [event.description for event in events],
+                created_at=[event.timestamp for event in events],
+                type=MemoryType.OBSERVATION,
+                log=False,
+                embeddings=[event.embedding for event in events],
+            )
 
         return events
 
@@ -1073,8 +1188,7 @@ class Agent(BaseModel):
         # Work through the plans
         await self._do_first_plan()
 
-        # Reflect, if we should
-        if await self._should_reflect():
-            await self._reflect()
+        # Reflect in the background, if we should
+        self._schedule_reflection()
 
         await self.write_progress_to_file()
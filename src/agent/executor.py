@@ -34,6 +34,7 @@ from ..utils.colors import LogColor
 from ..utils.formatting import print_to_console
 from ..utils.models import ChatModel
 from ..utils.parameters import DEFAULT_FAST_MODEL, DEFAULT_SMART_MODEL
+from ..utils.parsing import extract_json_object
 from ..utils.prompt import PromptString
 from .message import AgentMessage, get_conversation_history
 from .plans import PlanStatus, SinglePlan
@@ -72,6 +73,12 @@ class CustomPromptTemplate(BaseChatPromptTemplate):
         return [HumanMessage(content=formatted)]
 
 
+ACTION_REGEX = r"Action\s*\d*\s*:(.*?)\nAction\s*\d*\s*Input\s*\d*\s*:[\s]*(.*)"
+
+# Also accepts markdown emphasis, any casing and blank lines between the two fields
+TOLERANT_ACTION_REGEX = r"\**Action\s*\d*\s*\**\s*:\**(.*?)\n+\s*\**Action\s*\d*\s*Input\s*\d*\s*\**\s*:\**[\s]*(.*)"
+
+
 # set up the output parser
 class CustomOutputParser(AgentOutputParser):
     tools: List[BaseTool]
@@ -81,6 +88,26 @@ class CustomOutputParser(AgentOutputParser):
 
         self.tools = kwargs.pop("tools")
 
+    def _parse_action(self, llm_output: str) -> Optional[tuple[str, Any]]:
+        """Cheap, local attempts at pulling the action and its input out of the output"""
+        match = re.search(ACTION_REGEX, llm_output, re.DOTALL) or re.search(
+            TOLERANT_ACTION_REGEX, llm_output, re.DOTALL | re.IGNORECASE
+        )
+        if match:
+            return match.group(1).strip().strip("*").strip(), match.group(2)
+
+        # Some models answer with a JSON object instead
+        parsed = extract_json_object(llm_output)
+        if parsed is not None:
+            action = parsed.get("action", parsed.get("tool"))
+            action_input = parsed.get(
+                "action_input", parsed.get("tool_input", parsed.get("input"))
+            )
+            if isinstance(action, str) and action_input is not None:
+                return action.strip(), action_input
+
+        return None
+
     def parse(self, llm_output: str) -> Union[AgentAction, AgentFinish]:
         # Check if agent should finish
         if "Final Response:" in llm_output:
@@ -93,33 +120,42 @@ class CustomOutputParser(AgentOutputParser):
                 log=llm_output,
             )
         # Parse out the action and action input
-        regex = r"Action\s*\d*\s*:(.*?)\nAction\s*\d*\s*Input\s*\d*\s*:[\s]*(.*)"
-        match = re.search(regex, llm_output, re.DOTALL)
-        if not match:
-            llm = ChatModel(DEFAULT_FAST_MODEL)
+        parsed = self._parse_action(llm_output)
+        if parsed is None:
+            raise OutputParserException(f"Could not parse LLM output: `{llm_output}`")
 
-            formatting_correction = f"Could not parse the LLM output: `{llm_output}`\n\n Reformat the output to correspond to the following format: {self.get_format_instructions()} so that the result can be extracted using the regex: `{regex}`"
+        action, action_input = parsed
+        # try parsing action_input as json
+        if isinstance(action_input, str):
+            try:
+                action_input = json.loads(action_input)
+            except json.JSONDecodeError:
+                action_input = action_input.strip(" ").strip('"')
+        # Return the action and action input
+        return AgentAction(tool=action, tool_input=action_input, log=llm_output)
 
-            retry = llm.get_chat_completion_sync(
-                [SystemMessage(content=formatting_correction)]
-            )
+    async def aparse(self, llm_output: str) -> Union[AgentAction, AgentFinish]:
+        """Parses the output, asking the fast model to reformat it if that fails"""
+        try:
+            return self.parse(llm_output)
+        except OutputParserException:
+            pass
 
-            match = re.search(regex, retry, re.DOTALL)
+        llm = ChatModel(DEFAULT_FAST_MODEL)
 
-            if not match:
-                raise OutputParserException(
-                    f"Could not parse LLM output after retrying: \n`{retry}`. \nFirst attempt: \n`{retry}`"
-                )
+        formatting_correction = f"Could not parse the LLM output: `{llm_output}`\n\n Reformat the output to correspond to the following format: {self.get_format_instructions()} so that the result can be extracted using the regex: `{ACTION_REGEX}`"
+
+        retry = await llm.get_chat_completion(
+            [SystemMessage(content=formatting_correction)],
+            prompt_type=PromptString.OUTPUT_FORMAT,
+        )
 
-        action = match.group(1).strip()
-        action_input = match.group(2)
-        # try parsing action_input as json
         try:
-            action_input = json.loads(action_input)
-        except json.JSONDecodeError:
-            action_input = action_input.strip(" ").strip('"')
-        # Return the action and action input
-        return AgentAction(tool=action, tool_input=action_input, log=llm_output)
+            return self.parse(retry)
+        except OutputParserException:
+            raise OutputParserException(
+                f"Could not parse LLM output after retrying: \n`{retry}`. \nFirst attempt: \n`{llm_output}`"
+            )
 
     def get_format_instructions(self) -> str:
         tool_names = ", ".join([tool.name for tool in self.tools])
@@ -135,10 +171,27 @@ class PlanExecutorResponse(BaseModel):
 
 
 class CustomSingleActionAgent(LLMSingleActionAgent):
+    # Every request goes through this, so it shares the cache, limiter and
+    # scheduler. The chain is only used for its prompt.
+    chat_model: ChatModel
+
+    class Config:
+        arbitrary_types_allowed = True
+
     @override
-    def plan(self, *args, **kwargs) -> Union[AgentAction, AgentFinish]:
+    async def aplan(
+        self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs
+    ) -> Union[AgentAction, AgentFinish]:
+        async def get_output() -> str:
+            messages = self.llm_chain.prompt.format_messages(
+                intermediate_steps=intermediate_steps, **kwargs
+            )
+            return await self.chat_model.get_chat_completion(
+                messages, prompt_type=PromptString.EXECUTE_PLAN, stop=self.stop
+            )
+
         try:
-            result = super().plan(*args, **kwargs)
+            result = await self.output_parser.aparse(await get_output())
 
         # If there's an output parsing error, try again, with a reminder about the output format
         except OutputParserException as e:
@@ -146,7 +199,7 @@ class CustomSingleActionAgent(LLMSingleActionAgent):
 
             if "input" in kwargs:
                 kwargs["input"] = kwargs["input"] + PromptString.OUTPUT_FORMAT.value
-            result = super().plan(*args, **kwargs)
+            result = await self.output_parser.aparse(await get_output())
 
         return result
 
@@ -192,14 +245,15 @@ class PlanExecutor(BaseModel):
         )
 
         # set up a simple completion llm
-        llm = ChatModel(model_name=DEFAULT_SMART_MODEL, temperature=0).defaultModel
+        llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0)
 
         # LLM chain consisting of the LLM and a prompt
-        llm_chain = LLMChain(llm=llm, prompt=prompt)
+        llm_chain = LLMChain(llm=llm.defaultModel, prompt=prompt)
 
         output_parser = CustomOutputParser(tools=tools)
 
         executor = CustomSingleActionAgent(
+            chat_model=llm,
             llm_chain=llm_chain,
             output_parser=output_parser,
             stop=["\nObservation:"],
@@ -267,7 +321,7 @@ class PlanExecutor(BaseModel):
         else:
             relevant_memories = ""
 
-        response = executor.plan(
+        response = await executor.aplan(
             input=self.plan.make_plan_prompt(),
             intermediate_steps=intermediate_steps,
             your_name=self.context.get_agent_full_name(self.agent_id),
@@ -1,5 +1,27 @@
+import asyncio
+from typing import Optional
+
+from langchain.output_parsers import PydanticOutputParser
+from langchain.schema import OutputParserException
 from pydantic import BaseModel, Field, validator
 
+from ..utils.models import ChatModel
+from ..utils.parameters import DEFAULT_SMART_MODEL
+from ..utils.parsing import RepairingOutputParser, repair_and_parse
+from ..utils.prompt import Prompter, PromptString
+from .prescore import (
+    DEFAULT_PRESCORERS,
+    PRESCORE_CONFIDENCE_THRESHOLD,
+    ImportancePrescorer,
+    prescore_importance,
+)
+
+# How long to wait for other agents' memories before rating a batch, in seconds
+IMPORTANCE_BATCH_WINDOW = 0.1
+
+# The most memories rated in a single prompt
+IMPORTANCE_BATCH_SIZE = 20
+
 
 class ImportanceRatingResponse(BaseModel):
     rating: int = Field(description="Importance integer from 1 to 10")
@@ -10,3 +32,198 @@ class ImportanceRatingResponse(BaseModel):
             raise ValueError(f"rating must be between 1 and 10. Got: {rating}")
 
         return rating
+
+
+class BatchImportanceRatingResponse(BaseModel):
+    ratings: list[int] = Field(
+        description="Importance integers from 1 to 10, one per memory, in order"
+    )
+
+    @validator("ratings")
+    def validate_ratings(cls, ratings):
+        for rating in ratings:
+            if rating < 1 or rating > 10:
+                raise ValueError(f"ratings must be between 1 and 10. Got: {rating}")
+
+        return ratings
+
+
+async def calculate_importance(
+    full_name: str, private_bio: str, memory_description: str
+) -> int:
+    # Set up a complex chat model
+    complex_llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0)
+
+    importance_parser = RepairingOutputParser.from_llm(
+        parser=PydanticOutputParser(pydantic_object=ImportanceRatingResponse),
+        llm=complex_llm,
+    )
+
+    # make importance prompter
+    importance_prompter = Prompter(
+        PromptString.IMPORTANCE,
+        {
+            "full_name": full_name,
+            "private_bio": private_bio,
+            "memory_description": memory_description,
+            "format_instructions": importance_parser.get_format_instructions(),
+        },
+    )
+
+    response = await complex_llm.get_chat_completion(
+        importance_prompter.prompt,
+        prompt_type=PromptString.IMPORTANCE,
+        until_json=True,
+        loading_text="🤔 Calculating memory importance...",
+    )
+
+    parsed_response: ImportanceRatingResponse = await importance_parser.aparse(response)
+
+    return parsed_response.rating
+
+
+class PendingRating(BaseModel):
+    full_name: str
+    private_bio: str
+    memory_description: str
+    future: asyncio.Future
+
+    class Config:
+        arbitrary_types_allowed = True
+
+
+class ImportanceService:
+    """Rates the importance of new memories for every agent.
+
+    Memories submitted within a short window, by any agent, are rated together in
+    a single prompt and each caller gets its own rating back. If a batch can't be
+    parsed, its memories are rated individually instead. Memories that a
+    prescorer can confidently rate never reach the LLM.
+    """
+
+    def __init__(
+        self,
+        window: float = IMPORTANCE_BATCH_WINDOW,
+        batch_size: int = IMPORTANCE_BATCH_SIZE,
+        prescorers: list[ImportancePrescorer] = DEFAULT_PRESCORERS,
+        confidence_threshold: float = PRESCORE_CONFIDENCE_THRESHOLD,
+    ):
+        self.window = window
+        self.batch_size = batch_size
+        self.prescorers = prescorers
+        self.confidence_threshold = confidence_threshold
+        self.pending: list[PendingRating] = []
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def rate(
+        self, full_name: str, private_bio: str, memory_description: str
+    ) -> int:
+        # Routine memories are rated locally, without asking the LLM
+        estimate = prescore_importance(memory_description, self.prescorers)
+        if estimate is not None and estimate.confidence >= self.confidence_threshold:
+            return estimate.rating
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(
+            PendingRating(
+                full_name=full_name,
+                private_bio=private_bio,
+                memory_description=memory_description,
+                future=future,
+            )
+        )
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_after_window())
+
+        return await future
+
+    async def _flush_after_window(self) -> None:
+        await asyncio.sleep(self.window)
+
+        pending, self.pending = self.pending, []
+        self.flush_task = None
+
+        await asyncio.gather(
+            *[
+                self._rate_batch(pending[start : start + self.batch_size])
+                for start in range(0, len(pending), self.batch_size)
+            ]
+        )
+
+    async def _rate_batch(self, batch: list[PendingRating]) -> None:
+        ratings = None
+        if len(batch) > 1:
+            try:
+                ratings = await self._request_ratings(batch)
+            except Exception:
+                pass
+
+        if ratings is None:
+            await asyncio.gather(*[self._rate_individually(item) for item in batch])
+            return
+
+        for item, rating in zip(batch, ratings):
+            if not item.future.done():
+                item.future.set_result(rating)
+
+    async def _request_ratings(self, batch: list[PendingRating]) -> Optional[list[int]]:
+        """Rates the whole batch in one prompt, or returns None if the response
+        doesn't have exactly one valid rating per memory"""
+        llm = ChatModel(DEFAULT_SMART_MODEL, temperature=0)
+        parser = PydanticOutputParser(pydantic_object=BatchImportanceRatingResponse)
+
+        memories = "\n\n".join(
+            f"{index}. Name: {item.full_name}\nBio: {item.private_bio}\nMemory: {item.memory_description}"
+            for index, item in enumerate(batch, start=1)
+        )
+
+        prompter = Prompter(
+            PromptString.IMPORTANCE_BATCH,
+            {
+                "memories": memories,
+                "format_instructions": parser.get_format_instructions(),
+            },
+        )
+
+        response = await llm.get_chat_completion(
+            prompter.prompt,
+            prompt_type=PromptString.IMPORTANCE_BATCH,
+            until_json=True,
+            loading_text="🤔 Calculating memory importance...",
+        )
+
+        try:
+            parsed_response: BatchImportanceRatingResponse = repair_and_parse(
+                parser, response
+            )
+        except OutputParserException:
+            return None
+
+        if len(parsed_response.ratings) != len(batch):
+            return None
+
+        return parsed_response.ratings
+
+    async def _rate_individually(self, item: PendingRating) -> None:
+        try:
+            rating = await calculate_importance(
+                item.full_name, item.private_bio, item.memory_description
+            )
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+            return
+
+        if not item.future.done():
+            item.future.set_result(rating)
+
+
+importance_service: Optional[ImportanceService] = None
+
+
+def get_importance_service() -> ImportanceService:
+    global importance_service
+    if importance_service is None:
+        importance_service = ImportanceService()
+    return importance_service
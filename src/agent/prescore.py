@@ -0,0 +1,69 @@
+import abc
+import re
+from typing import Optional
+
+from pydantic import BaseModel
+
+# Estimates at least this confident are used instead of asking the LLM
+PRESCORE_CONFIDENCE_THRESHOLD = 0.9
+
+
+class ImportanceEstimate(BaseModel):
+    rating: int
+    confidence: float
+
+
+class ImportancePrescorer(abc.ABC):
+    """Estimates the importance of a memory locally, without calling the LLM."""
+
+    @abc.abstractmethod
+    def score(self, memory_description: str) -> Optional[ImportanceEstimate]:
+        """an estimate of the memory's importance, or None if it doesn't apply"""
+        pass
+
+
+class PrescoreRule(BaseModel):
+    pattern: str
+    rating: int
+    confidence: float
+
+
+class RegexPrescorer(ImportancePrescorer):
+    """Rates memories that match one of a list of known templates"""
+
+    def __init__(self, rules: list[PrescoreRule]):
+        self.rules = [(re.compile(rule.pattern), rule) for rule in rules]
+
+    def score(self, memory_description: str) -> Optional[ImportanceEstimate]:
+        for pattern, rule in self.rules:
+            if pattern.fullmatch(memory_description.strip()):
+                return ImportanceEstimate(
+                    rating=rule.rating, confidence=rule.confidence
+                )
+        return None
+
+
+# Short clauses, so that "X left the Y because ..." still goes to the LLM
+NAME = r"(?!.*\b(?:because|after|before|with|and|but|when|while)\b)[^\n.,;:!?]{1,60}"
+PLACE = r"[^\n.,;:!?]{1,40}"
+
+# The events agents generate when they move between locations
+MOVEMENT_RULES = [
+    PrescoreRule(pattern=f"{NAME} left the {PLACE}", rating=1, confidence=0.95),
+    PrescoreRule(pattern=f"{NAME} arrived at the {PLACE}", rating=1, confidence=0.95),
+]
+
+DEFAULT_PRESCORERS: list[ImportancePrescorer] = [RegexPrescorer(MOVEMENT_RULES)]
+
+
+def prescore_importance(
+    memory_description: str,
+    prescorers: list[ImportancePrescorer] = DEFAULT_PRESCORERS,
+) -> Optional[ImportanceEstimate]:
+    """Returns the most confident of the prescorers' estimates, if any"""
+    estimates = [prescorer.score(memory_description) for prescorer in prescorers]
+    return max(
+        [estimate for estimate in estimates if estimate is not None],
+        key=lambda estimate: estimate.confidence,
+        default=None,
+    )
@@ -1,11 +1,14 @@
 import asyncio
 import json
+import math
 import threading
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 from enum import Enum
 from typing import Any, Optional
 from uuid import UUID, uuid4
 
+import numpy as np
 import pytz
 from pydantic import BaseModel, Field
 from sqlalchemy import desc
@@ -53,6 +56,11 @@ class Event(BaseModel):
     description: str
     location_id: UUID
     metadata: Optional[Any]
+    # computed once by the world and shared by every witness, not stored in the db
+    embedding: Optional[np.ndarray] = Field(default=None, repr=False)
+
+    class Config:
+        arbitrary_types_allowed = True
 
     def __init__(
         self,
@@ -65,6 +73,7 @@ class Event(BaseModel):
         subtype: Optional[Subtype] = None,
         metadata: Optional[Any] = None,
         witness_ids: list[UUID] = [],
+        embedding: Optional[np.ndarray] = None,
         **kwargs: Any,
     ):
         if id is None:
@@ -101,6 +110,7 @@ class Event(BaseModel):
             location_id=location_id,
             metadata=metadata,
             witness_ids=witness_ids,
+            embedding=embedding,
         )
 
     def db_dict(self):
@@ -116,6 +126,22 @@ class Event(BaseModel):
             "metadata": self.metadata,
         }
 
+    @classmethod
+    def from_db_dict(cls, event: dict) -> "Event":
+        return cls(
+            id=event["id"],
+            type=EventType(event["type"]),
+            subtype=event["subtype"],
+            description=event["description"],
+            location_id=event["location_id"]
+            if isinstance(event["location_id"], str)
+            else event["location_id"]["id"],
+            agent_id=event["agent_id"],
+            timestamp=datetime.fromisoformat(event["timestamp"]),
+            witness_ids=event["witness_ids"],
+            metadata=event["metadata"],
+        )
+
     @classmethod
     async def from_id(cls, event_id: UUID) -> "Event":
         data = await (await get_database()).get_by_id(Tables.Events, str(event_id))
@@ -138,82 +164,310 @@ class Event(BaseModel):
         )
 
 
+def _timestamp(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value.timestamp()
+
+
+class EventBuffer:
+    """The most recent events, with indexes for the lookups get_events makes.
+
+    Events live in a fixed-capacity ring of slots ordered by timestamp, so
+    appending and evicting the oldest event are O(1) and `after` range queries
+    are a binary search. Removing an event leaves a tombstone in its slot, which
+    is reclaimed when it reaches the head of the ring or when the ring is
+    compacted. Events are also indexed by location, agent, witness and type, so
+    a lookup costs about as much as its result.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.events: dict[str, Event] = {}
+        # event ids in timestamp order, starting at `head`; None is a tombstone
+        self.slots: list[Optional[str]] = [None] * capacity
+        # tombstones keep their timestamp, so the slots stay sorted
+        self.timestamps: list[float] = [0.0] * capacity
+        self.head = 0
+        self.size = 0
+        self.tombstones = 0
+        self.slot_by_id: dict[str, int] = {}
+        self.by_location: dict[str, set[str]] = defaultdict(set)
+        self.by_agent: dict[str, set[str]] = defaultdict(set)
+        self.by_witness: dict[str, set[str]] = defaultdict(set)
+        self.by_type: dict[EventType, set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def __contains__(self, event_id: UUID | str) -> bool:
+        return str(event_id) in self.events
+
+    def _slot(self, position: int) -> int:
+        return (self.head + position) % self.capacity
+
+    def _position(self, slot: int) -> int:
+        return (slot - self.head) % self.capacity
+
+    def _bisect(self, timestamp: float) -> int:
+        """The position of the first slot newer than the timestamp"""
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[self._slot(middle)] > timestamp:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def newest_first(self) -> list[Event]:
+        return [
+            self.events[event_id]
+            for event_id in (
+                self.slots[self._slot(position)]
+                for position in reversed(range(self.size))
+            )
+            if event_id is not None
+        ]
+
+    def _indexes(self, event: Event) -> list[set[str]]:
+        return [
+            self.by_location[str(event.location_id)],
+            self.by_agent[str(event.agent_id)],
+            self.by_type[event.type],
+        ] + [self.by_witness[str(witness_id)] for witness_id in event.witness_ids]
+
+    def _evict_oldest(self) -> None:
+        event_id = self.slots[self.head]
+        if event_id is None:
+            self.tombstones -= 1
+        else:
+            self._unindex(event_id)
+            del self.slot_by_id[event_id]
+        self.slots[self.head] = None
+        self.head = self._slot(1)
+        self.size -= 1
+
+    def _drop_leading_tombstones(self) -> None:
+        while self.size > 0 and self.slots[self.head] is None:
+            self._evict_oldest()
+
+    def _compact(self) -> None:
+        """Moves the live events to the front of the ring, dropping tombstones"""
+        live = [
+            (self.slots[slot], self.timestamps[slot])
+            for slot in map(self._slot, range(self.size))
+            if self.slots[slot] is not None
+        ]
+        self.slots = [None] * self.capacity
+        self.head = 0
+        self.size = len(live)
+        self.tombstones = 0
+        for slot, (event_id, timestamp) in enumerate(live):
+            self.slots[slot] = event_id
+            self.timestamps[slot] = timestamp
+            self.slot_by_id[event_id] = slot
+
+    def add(self, event: Event) -> None:
+        event_id = str(event.id)
+        if event_id in self.events:
+            return
+
+        timestamp = _timestamp(event.timestamp)
+        if self.size == self.capacity:
+            # Older than everything in a full buffer, so it would be evicted right away
+            if timestamp < self.timestamps[self.head]:
+                return
+            self._evict_oldest()
+            self._drop_leading_tombstones()
+
+        # Events almost always arrive in order, so this rarely moves anything
+        position = self.size
+        while position > 0 and self.timestamps[self._slot(position - 1)] > timestamp:
+            previous, slot = self._slot(position - 1), self._slot(position)
+            self.slots[slot] = self.slots[previous]
+            self.timestamps[slot] = self.timestamps[previous]
+            if self.slots[slot] is not None:
+                self.slot_by_id[self.slots[slot]] = slot
+            position -= 1
+
+        slot = self._slot(position)
+        self.slots[slot] = event_id
+        self.timestamps[slot] = timestamp
+        self.slot_by_id[event_id] = slot
+        self.size += 1
+        self.events[event_id] = event
+        for index in self._indexes(event):
+            index.add(event_id)
+
+    def _unindex(self, event_id: str) -> None:
+        event = self.events.pop(event_id)
+        for index in self._indexes(event):
+            index.discard(event_id)
+
+    def remove(self, event_id: UUID | str) -> None:
+        event_id = str(event_id)
+        if event_id not in self.events:
+            return
+
+        self._unindex(event_id)
+        self.slots[self.slot_by_id.pop(event_id)] = None
+        self.tombstones += 1
+
+        self._drop_leading_tombstones()
+        if self.tombstones > self.capacity // 4:
+            self._compact()
+
+    def query(
+        self,
+        agent_id: Optional[UUID] = None,
+        location_id: Optional[UUID] = None,
+        type: Optional[EventType] = None,
+        description: Optional[str] = None,
+        after: Optional[datetime] = None,
+        witness_ids: Optional[list[UUID]] = None,
+    ) -> list[Event]:
+        """Returns the matching events, newest first"""
+        candidates: list[set[str]] = []
+        if location_id is not None:
+            candidates.append(self.by_location.get(str(location_id), set()))
+        if agent_id is not None:
+            candidates.append(self.by_agent.get(str(agent_id), set()))
+        if type is not None:
+            candidates.append(self.by_type.get(type, set()))
+        for witness_id in witness_ids or []:
+            candidates.append(self.by_witness.get(str(witness_id), set()))
+
+        after_timestamp = _timestamp(after) if after is not None else -math.inf
+        start = self._bisect(after_timestamp) if after is not None else 0
+        in_range = self.size - start
+
+        # Walk whichever is smaller, the time range or the smallest index lookup
+        candidates.sort(key=len)
+        if len(candidates) == 0 or in_range <= len(candidates[0]):
+            matching_ids = [
+                event_id
+                for event_id in (
+                    self.slots[self._slot(position)]
+                    for position in range(start, self.size)
+                )
+                if event_id is not None
+                and all(event_id in candidate for candidate in candidates)
+            ]
+        else:
+            matching_ids = sorted(
+                (
+                    event_id
+                    for event_id in candidates[0]
+                    if self.timestamps[self.slot_by_id[event_id]] > after_timestamp
+                    and all(event_id in candidate for candidate in candidates[1:])
+                ),
+                key=lambda event_id: self._position(self.slot_by_id[event_id]),
+            )
+
+        events = [self.events[event_id] for event_id in reversed(matching_ids)]
+        if description is not None:
+            events = [event for event in events if event.description == description]
+        return events
+
+
 RECENT_EVENTS_BUFFER = 500
 
 REFRESH_INTERVAL_SECONDS = 5
 
+# How far before the newest event we've seen a refresh looks for new events
+REFRESH_OVERLAP_SECONDS = 5
+
 
 class EventsManager(BaseModel):
-    recent_events: list[Event] = []
+    buffer: EventBuffer
     world_id: str
     last_refresh: datetime
     refresh_lock: Any
+    # the high-water mark incremental refreshes fetch from
+    latest_event_timestamp: Optional[datetime] = None
+    last_refresh_started: Optional[datetime] = None
+
+    class Config:
+        arbitrary_types_allowed = True
 
     def __init__(self, world_id: str, recent_events: list[Event]):
         last_refresh = datetime.now(pytz.utc)
 
+        buffer = EventBuffer(RECENT_EVENTS_BUFFER)
+        for event in recent_events:
+            buffer.add(event)
+
         super().__init__(
-            recent_events=recent_events,
+            buffer=buffer,
             world_id=world_id,
             last_refresh=last_refresh,
             refresh_lock=asyncio.Lock(),
         )
 
+    @property
+    def recent_events(self) -> list[Event]:
+        return self.buffer.newest_first()
+
+    def add_event(self, event: Event) -> None:
+        self.buffer.add(event)
+
     @classmethod
     async def from_world_id(cls, world_id: str):
-        data = await (await get_database()).get_recent_events(
-            world_id, RECENT_EVENTS_BUFFER
-        )
-        recent_events = [
-            Event(
-                type=EventType(event["type"]),
-                subtype=event["subtype"],
-                description=event["description"],
-                location_id=event["location_id"] if isinstance(event["location_id"], str) else event["location_id"]["id"],
-                timestamp=datetime.fromisoformat(event["timestamp"]),
-                witness_ids=event["witness_ids"],
-                metadata=event["metadata"],
-                agent_id=event["agent_id"],
-            )
-            for event in data
-        ]
-        return cls(
-            world_id=world_id,
-            recent_events=recent_events,
-        )
+        events_manager = cls(world_id=world_id, recent_events=[])
+        await events_manager.refresh_events()
+        return events_manager
 
     async def refresh_events(self) -> None:
-        """Gathers the last RECENT_EVENTS_BUFFER events from the database and updates the self.recent_events list"""
+        """Fetches the events added since the last refresh and merges them into
+        the buffer, which keeps the newest RECENT_EVENTS_BUFFER events"""
 
-        started_checking_events = datetime.now(pytz.utc)
+        requested_at = datetime.now(pytz.utc)
 
         async with self.refresh_lock:
-            # print("Refreshing events...")
-            data = await (await get_database()).get_recent_events(
-                self.world_id, RECENT_EVENTS_BUFFER
-            )
-            events = [
-                Event(
-                    id=event["id"],
-                    type=EventType(event["type"]),
-                    subtype=event["subtype"],
-                    description=event["description"],
-                    location_id=event["location_id"] if isinstance(event["location_id"], str) else event["location_id"]["id"],
-                    agent_id=event["agent_id"],
-                    timestamp=datetime.fromisoformat(event["timestamp"]),
-                    witness_ids=event["witness_ids"],
-                    metadata=event["metadata"],
+            # A refresh that started after this one was requested has already
+            # fetched everything this one would
+            if (
+                self.last_refresh_started is not None
+                and self.last_refresh_started >= requested_at
+            ):
+                return
+
+            started_checking_events = datetime.now(pytz.utc)
+            self.last_refresh_started = started_checking_events
+
+            database = await get_database()
+            if self.latest_event_timestamp is None:
+                data = await database.get_recent_events(
+                    self.world_id, RECENT_EVENTS_BUFFER
                 )
-                for event in data
-            ]
+            else:
+                # Look back a little, for events committed after newer ones
+                data = await database.get_events_since(
+                    self.world_id,
+                    self.latest_event_timestamp
+                    - timedelta(seconds=REFRESH_OVERLAP_SECONDS),
+                    RECENT_EVENTS_BUFFER,
+                )
+
+            # rows come newest first, and the buffer is cheapest to fill in order
+            for event in reversed(data):
+                if event["id"] not in self.buffer:
+                    self.buffer.add(Event.from_db_dict(event))
+
+            newest_timestamp = max(
+                [datetime.fromisoformat(event["timestamp"]) for event in data],
+                default=None,
+            )
+            if newest_timestamp is not None and (
+                self.latest_event_timestamp is None
+                or newest_timestamp > self.latest_event_timestamp
+            ):
+                self.latest_event_timestamp = newest_timestamp
 
-            self.recent_events = events
             self.last_refresh = (
-                max(
-                    datetime.fromisoformat(data[0]["timestamp"]),
-                    started_checking_events,
-                )
-                if len(data) > 0
+                max(newest_timestamp, started_checking_events)
+                if newest_timestamp is not None
                 else started_checking_events
             )
 
@@ -233,49 +487,16 @@ class EventsManager(BaseModel):
         ) or force_refresh:
             await self.refresh_events()
 
-        filtered_events = self.recent_events
-        if after is not None:
-            if after.tzinfo is None:
-                after = pytz.utc.localize(after)
-            filtered_events = [
-                event for event in filtered_events if event.timestamp > after
-            ]
-
-        if location_id is not None:
-            filtered_events = [
-                event
-                for event in filtered_events
-                if str(event.location_id) == str(location_id)
-            ]
-
-        if agent_id is not None:
-            filtered_events = [
-                event
-                for event in filtered_events
-                if str(event.agent_id) == str(agent_id)
-            ]
-
-        if type is not None:
-            filtered_events = [event for event in filtered_events if event.type == type]
-
-        if description is not None:
-            filtered_events = [
-                event for event in filtered_events if event.description == description
-            ]
-
-        if witness_ids is not None:
-            filtered_events = [
-                event
-                for event in filtered_events
-                if set(list(map(str, witness_ids))).issubset(
-                    set(list(map(str, event.witness_ids)))
-                )
-            ]
+        filtered_events = self.buffer.query(
+            agent_id=agent_id,
+            location_id=location_id,
+            type=type,
+            description=description,
+            after=after,
+            witness_ids=witness_ids,
+        )
 
         return (filtered_events, self.last_refresh)
 
-    def remove_event(self, event_id: UUID):
-        self.recent_events = [
-            event for event in self.recent_events if event.id != event_id
-        ]
-        return self.recent_events
+    def remove_event(self, event_id: UUID) -> None:
+        self.buffer.remove(event_id)
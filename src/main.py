@@ -6,6 +6,7 @@ import webbrowser
 from multiprocessing import Process
 from time import sleep
 
+import aiohttp
 import openai
 from dotenv import load_dotenv
 
@@ -15,6 +16,7 @@ from src.world.base import World
 
 from .utils.colors import LogColor
 from .utils.database.base import Tables
+from .utils.embedding_cache import close_embedding_caches
 from .utils.formatting import print_to_console
 from .utils.logging import init_logging
 from .utils.parameters import DISCORD_ENABLED
@@ -28,6 +30,13 @@ init_logging()
 
 async def run_world_async():
     openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    # Share one connection pool between all OpenAI requests
+    http_session = aiohttp.ClientSession()
+    openai.aiosession.set(http_session)
+
+    world = None
+
     try:
         database = await get_database()
 
@@ -48,7 +57,11 @@ async def run_world_async():
     except Exception:
         print(traceback.format_exc())
     finally:
+        if world is not None:
+            await world.stop()
+        close_embedding_caches()
         await (await get_database()).close()
+        await http_session.close()
 
 
 def run_world():
@@ -1,3 +1,4 @@
+import asyncio
 import math
 from datetime import datetime, timedelta, tzinfo
 from enum import Enum
@@ -8,7 +9,7 @@ import numpy as np
 import pytz
 from pydantic import BaseModel
 
-from ..utils.embeddings import cosine_similarity, get_embedding
+from ..utils.embeddings import get_embedding
 from ..utils.formatting import parse_array
 from ..utils.parameters import (
     IMPORTANCE_WEIGHT,
@@ -16,6 +17,7 @@ from ..utils.parameters import (
     SIMILARITY_WEIGHT,
     TIME_SPEED_MULTIPLIER,
 )
+from .index import IVFIndex
 
 
 class MemoryType(Enum):
@@ -68,10 +70,12 @@ class SingleMemory(BaseModel):
         if id is None:
             id = uuid4()
 
-        if isinstance(embedding, str):
+        if isinstance(embedding, bytes):
+            embedding = np.frombuffer(embedding, dtype=np.float32)
+        elif isinstance(embedding, str):
             embedding = parse_array(embedding)
-        else:
-            embedding = np.array(embedding)
+
+        embedding = np.asarray(embedding, dtype=np.float32)
 
         if not isinstance(embedding, np.ndarray):
             raise ValueError("Embedding must be a numpy array")
@@ -94,7 +98,7 @@ class SingleMemory(BaseModel):
             "agent_id": str(self.agent_id),
             "type": self.type.value,
             "description": self.description,
-            "embedding": str(self.embedding.tolist()),
+            "embedding": self.embedding,
             "importance": self.importance,
             "created_at": self.created_at.isoformat(),
             "last_accessed": self.last_accessed.isoformat()
@@ -112,43 +116,225 @@ class SingleMemory(BaseModel):
     def update_last_accessed(self):
         self.last_accessed = datetime.now(tz=pytz.utc)
 
-    async def similarity(self, query: str) -> float:
-        query_embedding = await get_embedding(query)
-        return cosine_similarity(self.embedding, query_embedding)
 
-    async def relevance(self, query: str) -> float:
-        return (
-            IMPORTANCE_WEIGHT * self.importance
-            + SIMILARITY_WEIGHT * (await self.similarity(query))
-            + RECENCY_WEIGHT * self.recency
+def recency_scores(last_accessed: np.ndarray) -> np.ndarray:
+    """Vectorized equivalent of SingleMemory.recency for an array of POSIX timestamps"""
+    hours_ago = (datetime.now(pytz.utc).timestamp() - last_accessed) * (
+        TIME_SPEED_MULTIPLIER / 3600
+    )
+    return np.power(0.99, hours_ago)
+
+
+def relevance_scores(
+    query_embedding: np.ndarray,
+    embeddings: np.ndarray,
+    importance: np.ndarray,
+    last_accessed: np.ndarray,
+) -> np.ndarray:
+    """Scores every row of an (N x D) embedding matrix against a single query embedding"""
+    norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query_embedding)
+    similarity = (embeddings @ query_embedding) / np.where(norms == 0, 1, norms)
+
+    return (
+        IMPORTANCE_WEIGHT * importance
+        + SIMILARITY_WEIGHT * similarity
+        + RECENCY_WEIGHT * recency_scores(last_accessed)
+    )
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns the indices of the k highest scores, highest first"""
+    if k <= 0 or len(scores) == 0:
+        return np.array([], dtype=int)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def _timestamp(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value.timestamp()
+
+
+MEMORY_TYPE_CODES = {memory_type: code for code, memory_type in enumerate(MemoryType)}
+
+
+class MemoryStore:
+    """Keeps an agent's memories alongside contiguous, incrementally grown arrays
+    (a float32 embedding matrix plus importance, created_at, last_accessed and type
+    columns), so that retrieval can score every memory in a single NumPy pass.
+
+    The store shares the `memories` list it is given, and each memory's embedding
+    becomes a view onto its row of the matrix, so embeddings are only held once.
+    Once the store grows past MEMORY_ANN_THRESHOLD rows, retrieval uses an
+    approximate nearest-neighbour index to pick candidates before re-ranking.
+    """
+
+    def __init__(self, memories: list[SingleMemory], initial_capacity: int = 256):
+        self.memories = memories
+        self.capacity = 0
+        self.size = 0
+        self.embeddings: np.ndarray = None
+        self.importance = np.empty(0, dtype=np.float32)
+        self.created_at = np.empty(0, dtype=np.float64)
+        self.last_accessed = np.empty(0, dtype=np.float64)
+        self.types = np.empty(0, dtype=np.int8)
+        self.initial_capacity = initial_capacity
+        self.index = IVFIndex()
+        self.training_task: Optional[asyncio.Task] = None
+
+        existing = list(memories)
+        memories.clear()
+        self.extend(existing)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _reserve(self, rows: int, dimensions: int):
+        if self.embeddings is None:
+            self.embeddings = np.empty((0, dimensions), dtype=np.float32)
+
+        if self.size + rows <= self.capacity:
+            return
+
+        capacity = max(self.capacity, self.initial_capacity)
+        while capacity < self.size + rows:
+            capacity *= 2
+
+        def grow(array: np.ndarray) -> np.ndarray:
+            grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[: self.size] = array[: self.size]
+            return grown
+
+        self.embeddings = grow(self.embeddings)
+        self.importance = grow(self.importance)
+        self.created_at = grow(self.created_at)
+        self.last_accessed = grow(self.last_accessed)
+        self.types = grow(self.types)
+        self.capacity = capacity
+
+        # re-point existing memories at the new matrix so the old one can be freed
+        for row, memory in enumerate(self.memories):
+            memory.embedding = self.embeddings[row]
+
+    def append(self, memory: SingleMemory) -> None:
+        self.extend([memory])
+
+    def extend(self, memories: list[SingleMemory]) -> None:
+        if len(memories) == 0:
+            return
+
+        self._reserve(len(memories), memories[0].embedding.shape[-1])
+
+        for memory in memories:
+            row = self.size
+            self.embeddings[row] = memory.embedding
+            self.importance[row] = memory.importance
+            self.created_at[row] = _timestamp(memory.created_at)
+            self.last_accessed[row] = _timestamp(memory.last_accessed)
+            self.types[row] = MEMORY_TYPE_CODES[memory.type]
+
+            memory.embedding = self.embeddings[row]
+            self.memories.append(memory)
+            self.size += 1
+
+        self.index.update(self.embeddings[: self.size])
+        self._schedule_training()
+
+    def _schedule_training(self) -> None:
+        """Re-clusters the index in the background once it has grown enough"""
+        if not self.index.needs_training or (
+            self.training_task is not None and not self.training_task.done()
+        ):
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop to train on yet, exact search works in the meantime
+            return
+
+        # rows below self.size never change, so the thread can read them while
+        # new ones are added
+        embeddings = self.embeddings[: self.size]
+
+        async def train() -> None:
+            await self.index.train(embeddings)
+            self.index.update(self.embeddings[: self.size])
+
+        self.training_task = loop.create_task(train())
+        self.training_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def most_recent(self, k: int) -> list[SingleMemory]:
+        """Returns the k most recently created memories, newest first"""
+        rows = top_k_indices(self.created_at[: self.size], k)
+        return [self.memories[row] for row in rows]
+
+    def relevance(self, query_embedding: np.ndarray) -> np.ndarray:
+        """Returns the relevance of every memory in the store to the query embedding"""
+        return relevance_scores(
+            query_embedding,
+            embeddings=self.embeddings[: self.size],
+            importance=self.importance[: self.size],
+            last_accessed=self.last_accessed[: self.size],
         )
 
+    def top_k(self, query_embedding: np.ndarray, k: int) -> list[SingleMemory]:
+        """Returns the k most relevant memories, most relevant first"""
+        if self.size == 0:
+            return []
 
-class RelatedMemory(BaseModel):
-    memory: SingleMemory
-    relevance: float
+        self._schedule_training()
+        if not self.index.ready:
+            scores = self.relevance(query_embedding)
+            return [self.memories[row] for row in top_k_indices(scores, k)]
 
-    def __str__(self) -> str:
-        return f"SingleMemory: {self.memory.description}, Relevance: {self.relevance}"
+        # The index only knows about similarity, so also consider the rows that
+        # score best on importance and recency alone before re-ranking
+        importance_and_recency = IMPORTANCE_WEIGHT * self.importance[
+            : self.size
+        ] + RECENCY_WEIGHT * recency_scores(self.last_accessed[: self.size])
+        candidates = np.union1d(
+            self.index.search(query_embedding),
+            top_k_indices(importance_and_recency, k),
+        )
+
+        scores = relevance_scores(
+            query_embedding,
+            embeddings=self.embeddings[candidates],
+            importance=self.importance[candidates],
+            last_accessed=self.last_accessed[candidates],
+        )
+        return [self.memories[candidates[i]] for i in top_k_indices(scores, k)]
 
 
 async def get_relevant_memories(
-    query: str, memories: list[SingleMemory], k: int = 5
+    query: str, memories: MemoryStore | list[SingleMemory], k: int = 5
 ) -> list[SingleMemory]:
     """Returns a list of the top k most relevant NON MESSAGE memories, based on the query string"""
 
-    memories_with_relevance = [
-        RelatedMemory(memory=memory, relevance=await memory.relevance(query))
-        for memory in memories
-    ]
+    if len(memories) == 0:
+        return []
 
-    # Sort the list of dictionaries based on the 'relevance' key in descending order
-    sorted_by_relevance = sorted(
-        memories_with_relevance, key=lambda x: x.relevance, reverse=True
-    )
+    # Embed the query once, then score every memory in a single pass
+    query_embedding = await get_embedding(query)
 
     # get the top k memories, as a list of SingleMemory object
-    top_memories = [memory.memory for memory in sorted_by_relevance[:k]]
+    if isinstance(memories, MemoryStore):
+        top_memories = memories.top_k(query_embedding, k)
+    else:
+        scores = relevance_scores(
+            query_embedding,
+            embeddings=np.stack([memory.embedding for memory in memories]),
+            importance=np.array([memory.importance for memory in memories]),
+            last_accessed=np.array(
+                [_timestamp(memory.last_accessed) for memory in memories]
+            ),
+        )
+        top_memories = [memories[index] for index in top_k_indices(scores, k)]
 
     # now sort the list based on the created_at field, with the oldest memories first
     sorted_by_created_at = sorted(
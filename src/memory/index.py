@@ -0,0 +1,149 @@
+import asyncio
+
+import numpy as np
+
+from ..utils.parameters import (
+    MEMORY_ANN_N_PROBE,
+    MEMORY_ANN_RETRAIN_FACTOR,
+    MEMORY_ANN_THRESHOLD,
+)
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+ASSIGN_CHUNK_SIZE = 8192
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _assign(embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), ASSIGN_CHUNK_SIZE):
+        chunk = _normalize(embeddings[start : start + ASSIGN_CHUNK_SIZE])
+        assignments[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def _cluster(embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Clusters the rows with spherical k-means, returning the centroids and the
+    cluster of every row"""
+    n_lists = max(1, int(np.sqrt(len(embeddings))))
+    rng = np.random.default_rng(0)
+
+    sample_size = min(len(embeddings), n_lists * KMEANS_SAMPLES_PER_LIST)
+    sample = _normalize(
+        embeddings[rng.choice(len(embeddings), sample_size, replace=False)]
+    )
+
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        # keep the previous centroid for any cluster that ended up empty
+        empty = np.bincount(labels, minlength=n_lists) == 0
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums)
+
+    centroids = centroids.astype(np.float32)
+    return centroids, _assign(embeddings, centroids)
+
+
+class IVFIndex:
+    """Approximate nearest-neighbour index over the rows of an embedding matrix.
+
+    Rows are clustered with spherical k-means and each cluster keeps the ids of
+    its rows. A query only scans the rows in its `n_probe` closest clusters, so
+    `n_probe` trades recall for latency. Below `threshold` rows the index stays
+    untrained and callers should fall back to an exact search.
+
+    Clustering is slow, so it runs in a worker thread via train(). Until it
+    finishes, new rows are assigned to the previous centroids, if there are any.
+    """
+
+    def __init__(
+        self,
+        n_probe: int = MEMORY_ANN_N_PROBE,
+        threshold: int = MEMORY_ANN_THRESHOLD,
+        retrain_factor: float = MEMORY_ANN_RETRAIN_FACTOR,
+    ):
+        self.n_probe = n_probe
+        self.threshold = threshold
+        self.retrain_factor = retrain_factor
+        self.centroids: np.ndarray = None
+        # the row ids in each cluster, grown by doubling like MemoryStore's arrays
+        self.lists: list[np.ndarray] = []
+        self.list_sizes = np.empty(0, dtype=np.int64)
+        self.size = 0
+        self.trained_size = 0
+        self.training = False
+
+    @property
+    def ready(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def needs_training(self) -> bool:
+        return (
+            not self.training
+            and self.size >= self.threshold
+            and (not self.ready or self.size >= self.trained_size * self.retrain_factor)
+        )
+
+    def _add_to_lists(self, rows: np.ndarray, assignments: np.ndarray) -> None:
+        order = np.argsort(assignments, kind="stable")
+        clusters, starts = np.unique(assignments[order], return_index=True)
+        for cluster, cluster_rows in zip(clusters, np.split(rows[order], starts[1:])):
+            size = self.list_sizes[cluster]
+            if size + len(cluster_rows) > len(self.lists[cluster]):
+                grown = np.empty(
+                    max(2 * len(self.lists[cluster]), size + len(cluster_rows)),
+                    dtype=np.int64,
+                )
+                grown[:size] = self.lists[cluster][:size]
+                self.lists[cluster] = grown
+            self.lists[cluster][size : size + len(cluster_rows)] = cluster_rows
+            self.list_sizes[cluster] = size + len(cluster_rows)
+
+    def _install(self, centroids: np.ndarray, assignments: np.ndarray) -> None:
+        self.centroids = centroids
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(len(centroids))]
+        self.list_sizes = np.zeros(len(centroids), dtype=np.int64)
+        self._add_to_lists(np.arange(len(assignments)), assignments)
+        self.size = len(assignments)
+        self.trained_size = len(assignments)
+
+    async def train(self, embeddings: np.ndarray) -> None:
+        """Clusters the given rows in a worker thread, then replaces the index with
+        one built from them. Call update() afterwards for any rows added since."""
+        self.training = True
+        try:
+            centroids, assignments = await asyncio.to_thread(_cluster, embeddings)
+        finally:
+            self.training = False
+        self._install(centroids, assignments)
+
+    def update(self, embeddings: np.ndarray) -> None:
+        """Brings the index up to date with the first len(embeddings) rows of the
+        matrix. Never clusters, check needs_training for that."""
+        size = len(embeddings)
+        if size <= self.size:
+            return
+
+        if self.ready:
+            self._add_to_lists(
+                np.arange(self.size, size),
+                _assign(embeddings[self.size : size], self.centroids),
+            )
+        self.size = size
+
+    def search(self, query_embedding: np.ndarray) -> np.ndarray:
+        """Returns the rows in the clusters closest to the query"""
+        n_probe = min(self.n_probe, len(self.centroids))
+        closeness = self.centroids @ _normalize(query_embedding)
+        probed = np.argpartition(-closeness, n_probe - 1)[:n_probe]
+        return np.concatenate(
+            [self.lists[cluster][: self.list_sizes[cluster]] for cluster in probed]
+        )
@@ -1,4 +1,4 @@
-from langchain.output_parsers import OutputFixingParser, PydanticOutputParser
+from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field, validator
 
 from src.tools.context import ToolContext
@@ -8,6 +8,7 @@ from src.utils.prompt import Prompter, PromptString
 
 from ..utils.models import ChatModel
 from ..utils.parameters import DEFAULT_FAST_MODEL, DEFAULT_SMART_MODEL
+from ..utils.parsing import RepairingOutputParser
 
 
 class HasHappenedLLMResponse(BaseModel):
@@ -25,9 +26,9 @@ async def wait_async(agent_input: str, tool_context: ToolContext) -> str:
 
     # Set up the LLM, Parser, and Prompter
     llm = ChatModel(temperature=0)
-    parser = OutputFixingParser.from_llm(
+    parser = RepairingOutputParser.from_llm(
         parser=PydanticOutputParser(pydantic_object=HasHappenedLLMResponse),
-        llm=llm.defaultModel,
+        llm=llm,
     )
 
     prompter = Prompter(
@@ -42,11 +43,12 @@ async def wait_async(agent_input: str, tool_context: ToolContext) -> str:
     # Get the response
     response = await llm.get_chat_completion(
         prompter.prompt,
+        prompt_type=PromptString.HAS_HAPPENED,
         loading_text="Checking if event has happened...",
     )
 
     # Parse the response
-    parsed_response: HasHappenedLLMResponse = parser.parse(response)
+    parsed_response: HasHappenedLLMResponse = await parser.aparse(response)
 
     if parsed_response.has_happened:
         return f"The event I was waiting for occured at {parsed_response.date_occured}. No need to wait anymore."
@@ -3,23 +3,27 @@ import hashlib
 import json
 import os
 import random
+import sqlite3
 import time
-from functools import wraps
+from collections import OrderedDict
+from functools import partial, wraps
+from typing import Any, Awaitable, Callable
 
 from langchain.schema import messages_to_dict
 
 from .spinner import Spinner
 
+# Legacy cache file, imported into the response store the first time it's opened
 CACHE_FILE = "cache.json"
 
+CACHE_DB_FILE = "cache.db"
 
-def get_hash(string: str):
-    return hashlib.sha256(string.encode("utf-8")).hexdigest()
+# The most responses kept, least recently used are evicted first
+CACHE_MAX_ENTRIES = 100000
 
 
-def save_cache(cache):
-    with open(CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+def get_hash(string: str):
+    return hashlib.sha256(string.encode("utf-8")).hexdigest()
 
 
 def load_cache():
@@ -29,7 +33,125 @@ def load_cache():
     return {}
 
 
-cache = load_cache()
+class ResponseStore:
+    """LLM response cache backed by SQLite.
+
+    Only the keys are held in memory, in least-recently-used order. Values are
+    loaded from disk when they are read, and each new response is a single row
+    insert instead of a rewrite of the whole cache.
+    """
+
+    def __init__(self, path: str = CACHE_DB_FILE, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, last_used REAL)"
+        )
+
+        self.keys: OrderedDict[str, None] = OrderedDict(
+            (key, None)
+            for (key,) in self.connection.execute(
+                "SELECT key FROM responses ORDER BY last_used"
+            )
+        )
+
+        if len(self.keys) == 0:
+            self.update(load_cache())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __getitem__(self, key: str):
+        row = self.connection.execute(
+            "SELECT value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.keys.pop(key, None)
+            raise KeyError(key)
+
+        self.keys.move_to_end(key)
+        self.connection.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return json.loads(row[0])
+
+    def __setitem__(self, key: str, value) -> None:
+        self.update({key: value})
+
+    def update(self, items: dict) -> None:
+        if len(items) == 0:
+            return
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO responses (key, value, last_used) VALUES (?, ?, ?)",
+                [(key, json.dumps(value), now) for key, value in items.items()],
+            )
+        for key in items:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+
+        self._evict()
+
+    def _evict(self) -> None:
+        excess = len(self.keys) - self.max_entries
+        if excess <= 0:
+            return
+
+        evicted = [self.keys.popitem(last=False)[0] for _ in range(excess)]
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM responses WHERE key = ?", [(key,) for key in evicted]
+            )
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+cache: ResponseStore = None
+
+
+def get_cache() -> ResponseStore:
+    # opened lazily, so each process gets its own connection
+    global cache
+    if cache is None:
+        cache = ResponseStore()
+    return cache
+
+
+in_flight: dict[str, asyncio.Task] = {}
+
+
+def _finish_flight(key: str, task: asyncio.Task) -> None:
+    if in_flight.get(key) is task:
+        del in_flight[key]
+    # mark any exception as retrieved, since there may be nobody waiting on it
+    if not task.cancelled():
+        task.exception()
+
+
+async def single_flight(key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+    """Runs func once for concurrent callers with the same key. Callers that arrive
+    while the first call is in flight await its result instead of repeating it.
+
+    The call runs in its own task, so a caller that is cancelled stops waiting
+    without cancelling the call for everyone else.
+    """
+    if key not in in_flight:
+        task = asyncio.ensure_future(func())
+        in_flight[key] = task
+        task.add_done_callback(partial(_finish_flight, key))
+
+    return await asyncio.shield(in_flight[key])
 
 
 def json_cache(sleep_range=(0, 0)):
@@ -42,11 +164,11 @@ def json_cache(sleep_range=(0, 0)):
             with Spinner(loading_text):
                 time.sleep(sleep_seconds)
             key = f"{func.__name__}_{args}_{kwargs}"
+            cache = get_cache()
             if key in cache:
                 return cache[key]
             result = func(*args, **kwargs)
             cache[key] = result
-            save_cache(cache)
             return result
 
         return wrapper
@@ -54,7 +176,9 @@ def json_cache(sleep_range=(0, 0)):
     return decorator
 
 
-def chat_json_cache(sleep_range=(0, 0)):
+def chat_json_cache(sleep_range=(0, 0), ignored_kwargs: list[str] = []):
+    """ignored_kwargs don't affect the response, so are left out of the cache key"""
+
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
@@ -65,15 +189,23 @@ def chat_json_cache(sleep_range=(0, 0)):
             # check if args[1] is list
             if len(args) > 1 and isinstance(args[1], list):
                 temp_args = messages_to_dict(args[1])
-            key_string = f"{func.__name__}_{temp_args}_{kwargs}"
+            key_kwargs = {
+                key: value for key, value in kwargs.items() if key not in ignored_kwargs
+            }
+            key_string = f"{func.__name__}_{temp_args}_{key_kwargs}"
             # set key to a consistent hash of key_string across runs
             key = get_hash(key_string)
+            cache = get_cache()
             if key in cache:
                 return cache[key]
-            result = await func(*args, **kwargs)
-            cache[key] = result
-            save_cache(cache)
-            return result
+
+            async def call():
+                result = await func(*args, **kwargs)
+                cache[key] = result
+                return result
+
+            # identical requests that are already in flight share one call
+            return await single_flight(key, call)
 
         return wrapper
 
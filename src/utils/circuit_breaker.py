@@ -0,0 +1,106 @@
+import time
+from collections import deque
+from enum import Enum
+from typing import Optional
+
+# Open the circuit once this fraction of the recent requests have failed
+FAILURE_RATE_THRESHOLD = 0.5
+# How many recent requests the failure rate is calculated over
+FAILURE_WINDOW = 20
+# Don't judge a model on fewer requests than this
+MINIMUM_REQUESTS = 5
+# Requests slower than this count as failures, in seconds
+SLOW_REQUEST_SECONDS = 120
+# How long the circuit stays open before a probe request is let through
+OPEN_SECONDS = 30
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Tracks the recent error rate and latency of a single model.
+
+    While closed every request is allowed. Once too many recent requests have
+    failed or been too slow the circuit opens and requests should go straight to
+    a fallback. After OPEN_SECONDS it half-opens and lets a single probe through,
+    closing again if the probe succeeds and re-opening if it fails.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CircuitState.CLOSED
+        self.results: deque[bool] = deque(maxlen=FAILURE_WINDOW)
+        self.opened_at: Optional[float] = None
+        self.probe_started_at: Optional[float] = None
+
+    @property
+    def failure_rate(self) -> float:
+        if len(self.results) == 0:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def allow_request(self) -> bool:
+        now = time.monotonic()
+
+        if self.state == CircuitState.OPEN:
+            if now - self.opened_at < OPEN_SECONDS:
+                return False
+            self.state = CircuitState.HALF_OPEN
+
+        if self.state == CircuitState.HALF_OPEN:
+            # a probe that never reported back doesn't block the circuit forever
+            if (
+                self.probe_started_at is not None
+                and now - self.probe_started_at < OPEN_SECONDS
+            ):
+                return False
+            self.probe_started_at = now
+
+        return True
+
+    def _open(self) -> None:
+        self.state = CircuitState.OPEN
+        self.opened_at = time.monotonic()
+        self.probe_started_at = None
+
+    def record_success(self, latency: float) -> None:
+        if latency > SLOW_REQUEST_SECONDS:
+            self.record_failure()
+            return
+
+        if self.state == CircuitState.HALF_OPEN:
+            self.state = CircuitState.CLOSED
+            self.probe_started_at = None
+            self.results.clear()
+
+        self.results.append(True)
+
+    def record_failure(self) -> None:
+        if self.state == CircuitState.HALF_OPEN:
+            self._open()
+            return
+
+        self.results.append(False)
+        if (
+            self.state == CircuitState.CLOSED
+            and len(self.results) >= MINIMUM_REQUESTS
+            and self.failure_rate >= FAILURE_RATE_THRESHOLD
+        ):
+            self._open()
+
+
+circuit_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(model_name: str) -> CircuitBreaker:
+    if model_name not in circuit_breakers:
+        circuit_breakers[model_name] = CircuitBreaker(model_name)
+    return circuit_breakers[model_name]
+
+
+def get_circuit_breaker_states() -> dict[str, CircuitState]:
+    return {name: breaker.state for name, breaker in circuit_breakers.items()}
@@ -60,6 +60,13 @@ class DatabaseProviderSingleton(AbstractSingleton):
         """get the most recent events"""
         pass
 
+    @abc.abstractmethod
+    async def get_events_since(
+        self, world_id: str, timestamp: datetime, limit: int
+    ) -> list[dict[str, Any]]:
+        """get the events at or after the timestamp, most recent first"""
+        pass
+
     @abc.abstractmethod
     async def get_messages_by_discord_id(self, discord_id: str) -> list[dict[str, Any]]:
         """get messages by discord id"""
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import json
 import uuid
@@ -5,6 +6,7 @@ from sqlite3 import Cursor
 from typing import Any, Coroutine
 
 import aiosqlite
+import numpy as np
 from genericpath import isfile
 from hyperdb import HyperDB
 from numpy import ndarray
@@ -19,6 +21,19 @@ class NumpyArrayEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# Bump this and add a step to SqliteDatabase._migrate when the schema changes
+SCHEMA_VERSION = 1
+
+
+def to_sql_value(value: Any) -> Any:
+    """Embeddings are stored as raw float32 blobs, lists and dicts as json"""
+    if isinstance(value, ndarray):
+        return value.astype(np.float32).tobytes()
+    if isinstance(value, list) or isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
 def dict_factory(cursor: Cursor, row: Any) -> dict[str, Any]:
     fields = [column[0] for column in cursor.description]
     row = [
@@ -32,6 +47,8 @@ def dict_factory(cursor: Cursor, row: Any) -> dict[str, Any]:
 
 class SqliteDatabase(DatabaseProviderSingleton):
     client: aiosqlite.Connection = None
+    # held by every write, since all callers share one connection and transaction
+    write_lock: asyncio.Lock = None
     documents = []
     vector_db: HyperDB = None
 
@@ -110,6 +127,15 @@ class SqliteDatabase(DatabaseProviderSingleton):
         ) as cursor:
             return await cursor.fetchall()
 
+    async def get_events_since(
+        self, world_id: str, timestamp: datetime, limit: int
+    ) -> list[dict[str, Any]]:
+        async with self.client.execute(
+            f"SELECT Events.*, Locations.world_id FROM Events INNER JOIN locations ON Events.location_id = locations.id WHERE Locations.world_id = ? AND Events.timestamp >= ? ORDER BY Events.timestamp DESC LIMIT ?",
+            (world_id, str(timestamp), limit),
+        ) as cursor:
+            return await cursor.fetchall()
+
     async def get_messages_by_discord_id(self, discord_id: str) -> list[dict[str, Any]]:
         async with self.client.execute(
             f"select * from events where metadata is not null and metadata->>'$.discord_id' = ?",
@@ -122,37 +148,47 @@ class SqliteDatabase(DatabaseProviderSingleton):
     ) -> None:
         if isinstance(data, dict):
             data = [data]
+
+        rows_by_columns: dict[tuple[str, ...], list[tuple]] = {}
         for item in data:
             if "id" not in item:
                 item["id"] = uuid.uuid4().hex
             for key, value in item.items():
-                if isinstance(value, list) or isinstance(value, dict):
-                    item[key] = json.dumps(value)
-            if upsert:
-                await self.client.execute(
-                    f"INSERT OR REPLACE INTO {table.value} ({','.join(item.keys())}) VALUES ({','.join(['?'] * len(item))})",
-                    tuple(item.values()),
-                )
-            else:
-                await self.client.execute(
-                    f"INSERT INTO {table.value} ({','.join(item.keys())}) VALUES ({','.join(['?'] * len(item))})",
-                    tuple(item.values()),
-                )
+                item[key] = to_sql_value(value)
+            rows_by_columns.setdefault(tuple(item.keys()), []).append(
+                tuple(item.values())
+            )
+
+        verb = "INSERT OR REPLACE" if upsert else "INSERT"
+
+        # every row goes in a single transaction, which no other write can commit
+        # or roll back halfway through
+        async with self.write_lock:
+            try:
+                for columns, rows in rows_by_columns.items():
+                    await self.client.executemany(
+                        f"{verb} INTO {table.value} ({','.join(columns)}) VALUES ({','.join(['?'] * len(columns))})",
+                        rows,
+                    )
+            except Exception:
+                await self.client.rollback()
+                raise
             await self.client.commit()
 
     async def update(self, table: Tables, id: str, data: dict) -> None:
         for key, value in data.items():
-            if isinstance(value, list) or isinstance(value, dict):
-                data[key] = json.dumps(value)
-        await self.client.execute(
-            f"UPDATE {table.value} SET {','.join([f'{key} = ?' for key in data.keys()])} WHERE id = ?",
-            tuple(data.values()) + (id,),
-        )
-        await self.client.commit()
+            data[key] = to_sql_value(value)
+        async with self.write_lock:
+            await self.client.execute(
+                f"UPDATE {table.value} SET {','.join([f'{key} = ?' for key in data.keys()])} WHERE id = ?",
+                tuple(data.values()) + (id,),
+            )
+            await self.client.commit()
 
     async def delete(self, table: Tables, id: str) -> None:
-        await self.client.execute(f"DELETE FROM {table.value} WHERE id = ?", (id,))
-        await self.client.commit()
+        async with self.write_lock:
+            await self.client.execute(f"DELETE FROM {table.value} WHERE id = ?", (id,))
+            await self.client.commit()
         if table == Tables.Documents:
             indexes = [
                 i for i, x in enumerate(self.vector_db.documents) if x["id"] == id
@@ -187,6 +223,7 @@ class SqliteDatabase(DatabaseProviderSingleton):
     @classmethod
     async def create(cls):
         cls.client = await aiosqlite.connect("database.db")
+        cls.write_lock = asyncio.Lock()
         cls.documents = []
         cls.vector_db = HyperDB(cls.documents, key="embedding_text")
         try:
@@ -281,7 +318,7 @@ class SqliteDatabase(DatabaseProviderSingleton):
             type TEXT CHECK (type IN ('reflection', 'observation')),
             description TEXT,
             related_memory_ids TEXT,
-            embedding TEXT,
+            embedding BLOB,
             importance INTEGER,
             last_accessed TIMESTAMP,
             FOREIGN KEY (agent_id) REFERENCES agents (id)
@@ -303,5 +340,31 @@ class SqliteDatabase(DatabaseProviderSingleton):
         """
         )
         await cls.client.commit()
+        await cls._migrate()
         cls.client.row_factory = dict_factory
         return cls()
+
+    @classmethod
+    async def _migrate(cls) -> None:
+        async with cls.client.execute("PRAGMA user_version") as cursor:
+            (version,) = await cursor.fetchone()
+
+        if version < 1:
+            # Memory embeddings used to be stored as stringified lists
+            async with cls.client.execute(
+                "SELECT id, embedding FROM memories WHERE typeof(embedding) = 'text'"
+            ) as cursor:
+                rows = await cursor.fetchall()
+            await cls.client.executemany(
+                "UPDATE memories SET embedding = ? WHERE id = ?",
+                [
+                    (to_sql_value(np.array(json.loads(embedding))), id)
+                    for id, embedding in rows
+                ],
+            )
+            await cls.client.commit()
+            if len(rows) > 0:
+                await cls.client.execute("VACUUM")
+
+        await cls.client.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        await cls.client.commit()
@@ -12,6 +12,17 @@ from src.utils.embeddings import get_embedding
 from src.utils.formatting import print_to_console
 
 
+def to_supabase_value(value: Any) -> Any:
+    """pgvector columns expect embeddings in their '[x, y, ...]' text form"""
+    if isinstance(value, ndarray):
+        return str(value.tolist())
+    return value
+
+
+def to_supabase_row(row: dict) -> dict:
+    return {key: to_supabase_value(value) for key, value in row.items()}
+
+
 class SupabaseDatabase(DatabaseProviderSingleton):
     client: Client
 
@@ -99,6 +110,19 @@ class SupabaseDatabase(DatabaseProviderSingleton):
             .execute()
         ).data
 
+    async def get_events_since(
+        self, world_id: str, timestamp: datetime, limit: int
+    ) -> List[Dict[str, Any]]:
+        return (
+            await self.client.table("Events")
+            .select("*, location_id(*)")
+            .eq("location_id.world_id", world_id)
+            .gte("timestamp", timestamp.isoformat())
+            .order("timestamp", desc=True)
+            .limit(limit)
+            .execute()
+        ).data
+
     async def get_messages_by_discord_id(self, discord_id: str) -> list[dict[str, Any]]:
         return (
             await self.client.table("Events")
@@ -110,12 +134,21 @@ class SupabaseDatabase(DatabaseProviderSingleton):
     async def insert(
         self, table: Tables, data: dict | list[dict], upsert=False
     ) -> None:
+        if isinstance(data, dict):
+            data = to_supabase_row(data)
+        else:
+            data = [to_supabase_row(item) for item in data]
         return (
             await self.client.table(table.value).insert(data, upsert=upsert).execute()
         )
 
     async def update(self, table: Tables, id: str, data: dict) -> None:
-        return await self.client.table(table.value).update(data).eq("id", id).execute()
+        return (
+            await self.client.table(table.value)
+            .update(to_supabase_row(data))
+            .eq("id", id)
+            .execute()
+        )
 
     async def delete(self, table: Tables, id: str) -> None:
         return await self.client.table(table.value).delete().eq("id", id).execute()
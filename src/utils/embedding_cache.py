@@ -0,0 +1,181 @@
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from .cache import get_hash
+
+EMBEDDING_CACHE_PREFIX = "embeddings"
+
+# The most embeddings kept on disk per model, least recently used are evicted first
+EMBEDDING_CACHE_MAX_ENTRIES = 100000
+
+INITIAL_CAPACITY = 1024
+
+
+class EmbeddingCache:
+    """Disk-backed, size-bounded LRU cache of embeddings for a single model.
+
+    Entries are keyed by sha256(model + text). Vectors live in a memory-mapped
+    float32 file with one row per slot, and the index is an append-only log of
+    `key slot` lines that is replayed on startup. When a slot is reused for a new
+    key, the key that previously held it is dropped. The log is compacted in LRU
+    order once it grows well past the number of live entries.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        prefix: str = EMBEDDING_CACHE_PREFIX,
+    ):
+        self.model = model
+        self.max_entries = max_entries
+        self.vectors_path = f"{prefix}-{model}.f32"
+        self.index_path = f"{prefix}-{model}.index"
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.dimensions: Optional[int] = None
+        self.vectors: Optional[np.memmap] = None
+        self.capacity = 0
+        self.next_slot = 0
+        self.log_lines = 0
+
+        self._load()
+        self.index_file = open(self.index_path, "a", encoding="utf-8")
+
+    def _load(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+
+        keys_by_slot: dict[int, str] = {}
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2:
+                    continue
+                if parts[0] == "dimensions":
+                    self.dimensions = int(parts[1])
+                    continue
+
+                key, slot = parts[0], int(parts[1])
+                previous_key = keys_by_slot.get(slot)
+                if previous_key is not None and previous_key != key:
+                    self.entries.pop(previous_key, None)
+                keys_by_slot[slot] = key
+                self.entries.pop(key, None)
+                self.entries[key] = slot
+                self.log_lines += 1
+
+        if self.dimensions is None or not os.path.exists(self.vectors_path):
+            self.entries.clear()
+            return
+
+        self.capacity = os.path.getsize(self.vectors_path) // (self.dimensions * 4)
+        self.entries = OrderedDict(
+            (key, slot) for key, slot in self.entries.items() if slot < self.capacity
+        )
+        self.next_slot = max(self.entries.values(), default=-1) + 1
+        if self.capacity > 0:
+            self._open_vectors()
+
+    def _open_vectors(self) -> None:
+        self.vectors = np.memmap(
+            self.vectors_path,
+            dtype=np.float32,
+            mode="r+",
+            shape=(self.capacity, self.dimensions),
+        )
+
+    def _grow(self, capacity: int) -> None:
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * self.dimensions * 4)
+        self.capacity = capacity
+        self._open_vectors()
+
+    def _write_log(self, line: str) -> None:
+        self.index_file.write(line + "\n")
+        self.index_file.flush()
+        self.log_lines += 1
+
+    def _compact(self) -> None:
+        self.index_file.close()
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(f"dimensions {self.dimensions}\n")
+            for key, slot in self.entries.items():
+                f.write(f"{key} {slot}\n")
+        os.replace(temp_path, self.index_path)
+        self.log_lines = len(self.entries)
+        self.index_file = open(self.index_path, "a", encoding="utf-8")
+
+    def key(self, text: str) -> str:
+        return get_hash(self.model + text)
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self.key(text)
+        slot = self.entries.get(key)
+        if slot is None:
+            return None
+
+        self.entries.move_to_end(key)
+
+        # copy, since the slot may be reused after an eviction
+        return np.array(self.vectors[slot])
+
+    def put(self, text: str, embedding: np.ndarray) -> None:
+        key = self.key(text)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        if self.dimensions is None:
+            self.dimensions = len(embedding)
+            self._write_log(f"dimensions {self.dimensions}")
+        elif len(embedding) != self.dimensions:
+            return
+
+        if len(self.entries) >= self.max_entries or self.next_slot >= self.max_entries:
+            _, slot = self.entries.popitem(last=False)
+        else:
+            slot = self.next_slot
+            self.next_slot += 1
+            if slot >= self.capacity:
+                self._grow(
+                    min(max(self.capacity * 2, INITIAL_CAPACITY), self.max_entries)
+                )
+
+        self.vectors[slot] = embedding
+        self.entries[key] = slot
+        self._write_log(f"{key} {slot}")
+
+        if self.log_lines > 2 * len(self.entries) + INITIAL_CAPACITY:
+            self._compact()
+
+    def close(self) -> None:
+        """Flushes the vectors and rewrites the log in LRU order. Lookups only
+        update recency in memory, so this is what carries it over to the next run.
+        """
+        if self.vectors is not None:
+            self.vectors.flush()
+        if self.dimensions is not None:
+            self._compact()
+        self.index_file.close()
+
+
+embedding_caches: dict[str, EmbeddingCache] = {}
+
+
+def get_embedding_cache(model: str) -> EmbeddingCache:
+    if model not in embedding_caches:
+        embedding_caches[model] = EmbeddingCache(model)
+    return embedding_caches[model]
+
+
+def close_embedding_caches() -> None:
+    for cache in embedding_caches.values():
+        cache.close()
+    embedding_caches.clear()
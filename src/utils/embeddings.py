@@ -1,9 +1,22 @@
+import asyncio
+from functools import partial
+from typing import Optional
+
 import numpy as np
 import openai
 import openai.error
-import asyncio
 
-from ..utils.cache import json_cache
+from ..utils.cache import json_cache, single_flight
+from .embedding_cache import get_embedding_cache
+from .rate_limit import estimate_tokens, get_rate_limiter, is_retryable_error
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# The most inputs the provider accepts in a single embedding request
+EMBEDDING_BATCH_SIZE = 2048
+
+# How long to wait for other callers before sending a batch, in seconds
+EMBEDDING_BATCH_WINDOW = 0.05
 
 
 def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
@@ -15,18 +28,144 @@ def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
     return similarity
 
 
-async def get_embedding(text: str, model="text-embedding-ada-002", max_retries=3) -> np.ndarray:
-    for attempt in range(max_retries):
+async def _request_embeddings(
+    texts: list[str], model: str, max_retries: int = 3
+) -> list[np.ndarray]:
+    """Embeds the given texts, sending at most EMBEDDING_BATCH_SIZE inputs per request"""
+    embeddings = []
+
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        chunk = [
+            text.replace("\n", " ")
+            for text in texts[start : start + EMBEDDING_BATCH_SIZE]
+        ]
+
+        for attempt in range(max_retries):
+            try:
+                async with get_rate_limiter(model).limit(
+                    estimate_tokens("".join(chunk))
+                ):
+                    response = await openai.Embedding.acreate(input=chunk, model=model)
+                break
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(1)  # Wait for 1 second before retrying
+                else:
+                    raise e  # If all retries failed, raise the exception
+
+        data = sorted(response["data"], key=lambda item: item["index"])
+        embeddings += [np.array(item["embedding"], dtype=np.float32) for item in data]
+
+    return embeddings
+
+
+class EmbeddingBatcher:
+    """Coalesces the embedding requests made within a short window, including those
+    of concurrently running agents, into as few provider requests as possible."""
+
+    def __init__(self, model: str, window: float = EMBEDDING_BATCH_WINDOW):
+        self.model = model
+        self.window = window
+        self.pending: list[tuple[str, asyncio.Future]] = []
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def embed(self, texts: list[str]) -> list[np.ndarray]:
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in texts]
+        self.pending += list(zip(texts, futures))
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_after_window())
+
+        return list(await asyncio.gather(*futures))
+
+    async def _flush_after_window(self) -> None:
+        await asyncio.sleep(self.window)
+
+        pending, self.pending = self.pending, []
+        self.flush_task = None
+
+        # Only send each distinct text once
+        unique_texts = list(dict.fromkeys(text for text, _ in pending))
+        results = await self._embed_isolating_failures(unique_texts)
+
+        for text, future in pending:
+            if future.done():
+                continue
+            if isinstance(results[text], Exception):
+                future.set_exception(results[text])
+            else:
+                future.set_result(results[text])
+
+    async def _embed_isolating_failures(
+        self, texts: list[str]
+    ) -> dict[str, np.ndarray | Exception]:
+        """Embeds the texts, bisecting a batch that the provider rejects so that
+        only the texts that caused the error fail"""
         try:
-            response: list[float] = await openai.Embedding.acreate(
-                input=[text.replace("\n", " ")], model=model
+            embeddings = await _request_embeddings(texts, self.model)
+        except Exception as e:
+            # an outage or rate limit isn't any one text's fault
+            if len(texts) == 1 or is_retryable_error(e):
+                return {text: e for text in texts}
+
+            middle = len(texts) // 2
+            halves = await asyncio.gather(
+                self._embed_isolating_failures(texts[:middle]),
+                self._embed_isolating_failures(texts[middle:]),
             )
+            return {**halves[0], **halves[1]}
 
-            embedding = response["data"][0]["embedding"]
+        return dict(zip(texts, embeddings))
 
-            return np.array(embedding)
-        except Exception as e:
-            if attempt < max_retries - 1:
-                await asyncio.sleep(1)  # Wait for 1 second before retrying
-            else:
-                raise e  # If all retries failed, raise the exception
+
+batchers: dict[str, EmbeddingBatcher] = {}
+
+
+async def get_embeddings(
+    texts: list[str], model=DEFAULT_EMBEDDING_MODEL
+) -> list[np.ndarray]:
+    if len(texts) == 0:
+        return []
+
+    # Only ask the provider for embeddings that aren't already cached on disk
+    cache = get_embedding_cache(model)
+    embeddings = [cache.get(text) for text in texts]
+    missing = [text for text, embedding in zip(texts, embeddings) if embedding is None]
+
+    if len(missing) > 0:
+        if model not in batchers:
+            batchers[model] = EmbeddingBatcher(model)
+
+        async def fetch(text: str) -> np.ndarray:
+            embedding = (await batchers[model].embed([text]))[0]
+            cache.put(text, embedding)
+            return embedding
+
+        # texts that are already being embedded for another caller are awaited,
+        # the rest are coalesced into a batch by the batcher
+        unique_missing = list(dict.fromkeys(missing))
+        fetched = dict(
+            zip(
+                unique_missing,
+                await asyncio.gather(
+                    *[
+                        single_flight(
+                            f"embedding_{cache.key(text)}", partial(fetch, text)
+                        )
+                        for text in unique_missing
+                    ]
+                ),
+            )
+        )
+
+        embeddings = [
+            fetched[text] if embedding is None else embedding
+            for text, embedding in zip(texts, embeddings)
+        ]
+
+    return embeddings
+
+
+async def get_embedding(text: str, model=DEFAULT_EMBEDDING_MODEL) -> np.ndarray:
+    return (await get_embeddings([text], model=model))[0]
@@ -36,10 +36,5 @@ def print_to_console(
 
 
 def parse_array(s: str) -> np.ndarray:
-    # Split the string by comma
-    elements = s.strip()[1:-1].split(",")
-
-    # Convert each element to a float and create a NumPy array
-    arr = np.array([float(e) for e in elements])
-
-    return arr
+    # Parse the comma separated floats between the brackets in a single pass
+    return np.fromstring(s.strip()[1:-1], dtype=np.float32, sep=",")
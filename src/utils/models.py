@@ -1,19 +1,45 @@
-from enum import Enum
+import asyncio
+import itertools
+import time
+from contextlib import aclosing, asynccontextmanager
+from enum import Enum, IntEnum
+from typing import AsyncIterator, Optional
 
 from dotenv import load_dotenv
 from langchain.chat_models import ChatAnthropic, ChatOpenAI
 from langchain.chat_models.base import BaseChatModel
+from langchain.chat_models.openai import acompletion_with_retry
 from langchain.llms import OpenAI
 from langchain.schema import BaseMessage
 from utils.windowai_model import ChatWindowAI
 
 from .cache import chat_json_cache, json_cache
+from .circuit_breaker import CircuitState, get_circuit_breaker
 from .model_name import ChatModelName
 from .parameters import DEFAULT_FAST_MODEL, DEFAULT_SMART_MODEL
+from .parsing import JsonObjectScanner
+from .prompt import PromptString
+from .rate_limit import (
+    RateLimiter,
+    backoff_seconds,
+    estimate_tokens,
+    get_rate_limiter,
+    is_rate_limit_error,
+    is_retryable_error,
+)
 from .spinner import Spinner
 
 load_dotenv()
 
+# Attempts per request before giving up on a model. Retries happen here rather
+# than in the client, so the rate limiter sees every rate limit error and no
+# concurrency slot is held while backing off.
+CHAT_MAX_ATTEMPTS = 4
+
+
+# Long-lived clients, keyed by model name and generation params
+chat_model_registry: dict[tuple, BaseChatModel] = {}
+
 
 def get_chat_model(name: ChatModelName, **kwargs) -> BaseChatModel:
     if "model_name" in kwargs:
@@ -21,10 +47,24 @@ def get_chat_model(name: ChatModelName, **kwargs) -> BaseChatModel:
     if "model" in kwargs:
         del kwargs["model"]
 
+    key = (name, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        # unhashable params, so this client can't be shared
+        return create_chat_model(name, **kwargs)
+
+    if key not in chat_model_registry:
+        chat_model_registry[key] = create_chat_model(name, **kwargs)
+    return chat_model_registry[key]
+
+
+def create_chat_model(name: ChatModelName, **kwargs) -> BaseChatModel:
     if name == ChatModelName.TURBO:
-        return ChatOpenAI(model_name=name.value, **kwargs)
+        # a single attempt, ChatModel does the retrying
+        return ChatOpenAI(model_name=name.value, max_retries=1, **kwargs)
     elif name == ChatModelName.GPT4:
-        return ChatOpenAI(model_name=name.value, **kwargs)
+        return ChatOpenAI(model_name=name.value, max_retries=1, **kwargs)
     elif name == ChatModelName.CLAUDE:
         return ChatAnthropic(model=name.value, **kwargs)
     elif name == ChatModelName.CLAUDE_INSTANT:
@@ -35,10 +75,101 @@ def get_chat_model(name: ChatModelName, **kwargs) -> BaseChatModel:
         raise ValueError(f"Invalid model name: {name}")
 
 
+class RequestPriority(IntEnum):
+    # on an agent's critical path, someone is waiting on the result
+    CRITICAL = 0
+    NORMAL = 1
+    # bookkeeping that can wait when the model is busy
+    BACKGROUND = 2
+
+
+PROMPT_PRIORITIES = {
+    PromptString.REACT: RequestPriority.CRITICAL,
+    PromptString.EXECUTE_PLAN: RequestPriority.CRITICAL,
+    PromptString.HAS_HAPPENED: RequestPriority.CRITICAL,
+    PromptString.OUTPUT_FORMAT: RequestPriority.CRITICAL,
+    PromptString.MAKE_PLANS: RequestPriority.NORMAL,
+    PromptString.IMPORTANCE: RequestPriority.BACKGROUND,
+    PromptString.IMPORTANCE_BATCH: RequestPriority.BACKGROUND,
+    PromptString.RECENT_ACTIIVITY: RequestPriority.BACKGROUND,
+    PromptString.REFLECTION_QUESTIONS: RequestPriority.BACKGROUND,
+    PromptString.REFLECTION_INSIGHTS: RequestPriority.BACKGROUND,
+    PromptString.GOSSIP: RequestPriority.BACKGROUND,
+}
+
+# A waiting request is promoted by one priority class for every this many seconds
+PRIORITY_AGING_SECONDS = 10
+
+
+def get_priority(prompt_type: Optional[PromptString]) -> RequestPriority:
+    return PROMPT_PRIORITIES.get(prompt_type, RequestPriority.NORMAL)
+
+
+class RequestScheduler:
+    """Decides which waiting request goes to a model's rate limiter next.
+
+    Only one request at a time waits on the limiter, the rest wait here and are
+    let through in priority order. Requests are promoted as they wait, so that
+    background work still gets through under sustained load.
+    """
+
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
+        self.waiting: list[tuple[RequestPriority, float, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.current: Optional[asyncio.Future] = None
+
+    def _effective_priority(self, entry) -> tuple[float, int]:
+        priority, enqueued_at, sequence, _ = entry
+        waited = time.monotonic() - enqueued_at
+        return (priority - waited / PRIORITY_AGING_SECONDS, sequence)
+
+    def _admit_next(self) -> None:
+        while self.current is None and self.waiting:
+            entry = min(self.waiting, key=self._effective_priority)
+            self.waiting.remove(entry)
+            future = entry[3]
+            if not future.done():
+                self.current = future
+                future.set_result(None)
+
+    def _end_turn(self, future: asyncio.Future) -> None:
+        if self.current is future:
+            self.current = None
+            self._admit_next()
+
+    @asynccontextmanager
+    async def limit(self, priority: RequestPriority, tokens: int):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((priority, time.monotonic(), next(self.sequence), future))
+        self._admit_next()
+
+        try:
+            await future
+            async with self.limiter.limit(tokens):
+                self._end_turn(future)
+                yield
+        finally:
+            self._end_turn(future)
+
+
+schedulers: dict[str, RequestScheduler] = {}
+
+
+def get_request_scheduler(model_name: ChatModelName) -> RequestScheduler:
+    if model_name.value not in schedulers:
+        schedulers[model_name.value] = RequestScheduler(
+            get_rate_limiter(model_name.value)
+        )
+    return schedulers[model_name.value]
+
+
 class ChatModel:
     """Wrapper around the ChatModel class."""
     defaultModel: BaseChatModel
     backupModel: BaseChatModel
+    default_model_name: ChatModelName
+    backup_model_name: ChatModelName
 
     def __init__(
         self,
@@ -46,22 +177,176 @@ class ChatModel:
         backup_model_name: ChatModelName = DEFAULT_FAST_MODEL,
         **kwargs,
     ):
+        self.default_model_name = default_model_name
+        self.backup_model_name = backup_model_name
         self.defaultModel = get_chat_model(default_model_name, **kwargs)
         self.backupModel = get_chat_model(backup_model_name, **kwargs)
 
-    @chat_json_cache(sleep_range=(0, 0))
-    async def get_chat_completion(self, messages: list[BaseMessage], **kwargs) -> str:
-        try:
-            resp = await self.defaultModel.agenerate([messages])
-        except Exception:
-            resp = await self.backupModel.agenerate([messages])
+    async def _agenerate(
+        self,
+        model: BaseChatModel,
+        name: ChatModelName,
+        messages: list[BaseMessage],
+        priority: RequestPriority,
+        stop: Optional[list[str]] = None,
+    ):
+        tokens = estimate_tokens("".join(message.content for message in messages))
+        circuit_breaker = get_circuit_breaker(name.value)
 
-        return resp.generations[0][0].text
+        for attempt in range(CHAT_MAX_ATTEMPTS):
+            try:
+                async with get_request_scheduler(name).limit(priority, tokens):
+                    started_at = time.monotonic()
+                    try:
+                        resp = await model.agenerate([messages], stop=stop)
+                    except Exception as e:
+                        # the limiter backs off on rate limits, they don't mean
+                        # the model is failing
+                        if not is_rate_limit_error(e):
+                            circuit_breaker.record_failure()
+                        raise
+                    circuit_breaker.record_success(time.monotonic() - started_at)
+                    return resp
+            except Exception as e:
+                if (
+                    attempt == CHAT_MAX_ATTEMPTS - 1
+                    or not is_retryable_error(e)
+                    or circuit_breaker.state == CircuitState.OPEN
+                ):
+                    raise
 
-    def get_chat_completion_sync(self, messages: list[BaseMessage], **kwargs) -> str:
-        try:
-            resp = self.defaultModel.generate([messages])
-        except Exception:
-            resp = self.backupModel.generate([messages])
+            # back off without holding a slot
+            await asyncio.sleep(backoff_seconds(attempt))
+
+    async def _astream(
+        self,
+        model: BaseChatModel,
+        name: ChatModelName,
+        messages: list[BaseMessage],
+        priority: RequestPriority,
+        stop: Optional[list[str]] = None,
+    ) -> AsyncIterator[str]:
+        """Yields the completion as it is generated. Only OpenAI models stream,
+        the others yield their whole completion at once."""
+        if not isinstance(model, ChatOpenAI):
+            resp = await self._agenerate(model, name, messages, priority, stop)
+            yield resp.generations[0][0].text
+            return
+
+        tokens = estimate_tokens("".join(message.content for message in messages))
+        circuit_breaker = get_circuit_breaker(name.value)
+        message_dicts, params = model._create_message_dicts(messages, stop)
+        params["stream"] = True
+
+        for attempt in range(CHAT_MAX_ATTEMPTS):
+            opened = False
+            try:
+                async with get_request_scheduler(name).limit(priority, tokens):
+                    started_at = time.monotonic()
+                    try:
+                        stream = await acompletion_with_retry(
+                            model, messages=message_dicts, **params
+                        )
+                        opened = True
+
+                        # closing the stream early hangs up on the rest of the
+                        # generation
+                        async with aclosing(stream):
+                            async for stream_resp in stream:
+                                token = stream_resp["choices"][0]["delta"].get(
+                                    "content", ""
+                                )
+                                if token:
+                                    yield token
+                    except Exception as e:
+                        if not is_rate_limit_error(e):
+                            circuit_breaker.record_failure()
+                        raise
+                    except GeneratorExit:
+                        # the caller had all it needed, which is still a success
+                        circuit_breaker.record_success(time.monotonic() - started_at)
+                        raise
+                    circuit_breaker.record_success(time.monotonic() - started_at)
+                    return
+            except Exception as e:
+                # only opening the stream is retried, never a partial completion
+                if (
+                    opened
+                    or attempt == CHAT_MAX_ATTEMPTS - 1
+                    or not is_retryable_error(e)
+                    or circuit_breaker.state == CircuitState.OPEN
+                ):
+                    raise
+
+            await asyncio.sleep(backoff_seconds(attempt))
+
+    async def stream_chat_completion(
+        self,
+        messages: list[BaseMessage],
+        prompt_type: Optional[PromptString] = None,
+        stop: Optional[list[str]] = None,
+    ) -> AsyncIterator[str]:
+        """Yields the completion token by token. Falls back to the backup model if
+        the default one fails before producing anything."""
+        priority = get_priority(prompt_type)
+
+        models = [(self.backupModel, self.backup_model_name)]
+        if get_circuit_breaker(self.default_model_name.value).allow_request():
+            models.insert(0, (self.defaultModel, self.default_model_name))
+
+        for index, (model, name) in enumerate(models):
+            started = False
+            try:
+                async with aclosing(
+                    self._astream(model, name, messages, priority, stop)
+                ) as stream:
+                    async for token in stream:
+                        started = True
+                        yield token
+                return
+            except Exception:
+                if started or index == len(models) - 1:
+                    raise
+
+    @chat_json_cache(sleep_range=(0, 0), ignored_kwargs=["prompt_type"])
+    async def get_chat_completion(
+        self,
+        messages: list[BaseMessage],
+        prompt_type: Optional[PromptString] = None,
+        stop: Optional[list[str]] = None,
+        until_json: bool = False,
+        **kwargs,
+    ) -> str:
+        """If until_json is set the completion is streamed, and cut off as soon as
+        it contains a complete JSON object."""
+        if until_json:
+            completion = ""
+            scanner = JsonObjectScanner()
+            async with aclosing(
+                self.stream_chat_completion(messages, prompt_type, stop)
+            ) as stream:
+                async for token in stream:
+                    completion += token
+                    end = scanner.feed(token)
+                    if end is not None:
+                        return completion[:end]
+            return completion
+
+        priority = get_priority(prompt_type)
+
+        if get_circuit_breaker(self.default_model_name.value).allow_request():
+            try:
+                resp = await self._agenerate(
+                    self.defaultModel, self.default_model_name, messages, priority, stop
+                )
+            except Exception:
+                resp = await self._agenerate(
+                    self.backupModel, self.backup_model_name, messages, priority, stop
+                )
+        else:
+            # Skip straight to the backup while the default model is failing
+            resp = await self._agenerate(
+                self.backupModel, self.backup_model_name, messages, priority, stop
+            )
 
         return resp.generations[0][0].text
@@ -15,6 +15,12 @@ RECENCY_WEIGHT = 1
 SIMILARITY_WEIGHT = 1
 IMPORTANCE_WEIGHT = 1
 REFLECTION_MEMORY_COUNT = 50
+# Approximate search kicks in once an agent has this many memories
+MEMORY_ANN_THRESHOLD = 20000
+# Clusters scanned per query, higher means better recall but slower retrieval
+MEMORY_ANN_N_PROBE = 8
+# Re-cluster the index once the number of memories has grown by this factor
+MEMORY_ANN_RETRAIN_FACTOR = 2
 PLAN_LENGTH = "24 hours"
 DEFAULT_LOCATION_ID = config.default_location_id
 DEFAULT_WORLD_ID = config.world_id
@@ -38,6 +44,19 @@ DEFAULT_FAST_MODEL = (
     else ChatModelName.TURBO
 )
 
+# Rate limits shared by every agent, as (requests per minute, tokens per minute)
+MODEL_RATE_LIMITS = {
+    ChatModelName.TURBO.value: (3500, 90000),
+    ChatModelName.GPT4.value: (200, 40000),
+    ChatModelName.CLAUDE.value: (50, 100000),
+    ChatModelName.CLAUDE_INSTANT.value: (50, 100000),
+    ChatModelName.WINDOW.value: (60, None),
+    "text-embedding-ada-002": (3000, 1000000),
+}
+DEFAULT_RATE_LIMIT = (60, None)
+# Upper bound for the adaptive number of concurrent requests per model
+MAX_CONCURRENT_REQUESTS = 16
+
 
 # Tools
 DISCORD_ENABLED = (
@@ -0,0 +1,200 @@
+import json
+import re
+from collections import Counter
+from typing import Any, Callable, Optional, TypeVar
+
+from langchain.output_parsers.prompts import NAIVE_FIX_PROMPT
+from langchain.prompts.base import BasePromptTemplate
+from langchain.schema import BaseOutputParser, OutputParserException
+
+from .prompt import PromptString
+
+T = TypeVar("T")
+
+CODE_FENCE_REGEX = r"```[a-zA-Z]*\s*\n?(.*?)```"
+TRAILING_COMMA_REGEX = r",(\s*[}\]])"
+
+CLOSING_BRACKETS = {"{": "}", "[": "]"}
+
+# How often each path through RepairingOutputParser was taken
+repair_counts: Counter[str] = Counter()
+
+
+def extract_json_object(text: str) -> Optional[dict]:
+    """Returns the first JSON object in the text, if there is one"""
+    decoder = json.JSONDecoder()
+    for start in [index for index, char in enumerate(text) if char == "{"]:
+        try:
+            value, _ = decoder.raw_decode(text[start:])
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
+
+
+def strip_code_fences(text: str) -> str:
+    match = re.search(CODE_FENCE_REGEX, text, re.DOTALL)
+    return match.group(1) if match else text
+
+
+def remove_trailing_commas(text: str) -> str:
+    return re.sub(TRAILING_COMMA_REGEX, r"\1", text)
+
+
+def balance_brackets(text: str) -> str:
+    """Closes any strings, objects and arrays left open at the end of the text"""
+    expected: list[str] = []
+    in_string = False
+    escaped = False
+
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in CLOSING_BRACKETS:
+            expected.append(CLOSING_BRACKETS[char])
+        elif expected and char == expected[-1]:
+            expected.pop()
+
+    if in_string:
+        text += '"'
+    return text + "".join(reversed(expected))
+
+
+def first_json_object(text: str) -> str:
+    parsed = extract_json_object(text)
+    return json.dumps(parsed) if parsed is not None else text
+
+
+class JsonObjectScanner:
+    """Finds where the first JSON object in a stream of text ends, without
+    rescanning the text that has already been fed to it."""
+
+    def __init__(self):
+        self.length = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> Optional[int]:
+        """Returns the length of the text up to the end of the first JSON object,
+        once all of it has been fed"""
+        for offset, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == "{":
+                self.depth += 1
+            # quotes and braces before the object starts are just prose
+            elif self.depth == 0:
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return self.length + offset + 1
+
+        self.length += len(text)
+        return None
+
+
+# Applied in order, each on top of the ones before it
+REPAIRS: list[tuple[str, Callable[[str], str]]] = [
+    ("code_fence", strip_code_fences),
+    ("trailing_comma", remove_trailing_commas),
+    ("balance_brackets", balance_brackets),
+    ("first_json_object", first_json_object),
+]
+
+
+def repair_and_parse(parser: BaseOutputParser[T], completion: str) -> T:
+    """Parses the completion, repairing it locally if needed. Raises the original
+    parsing error if no repair helped."""
+    try:
+        parsed_completion = parser.parse(completion)
+        repair_counts["clean"] += 1
+        return parsed_completion
+    except OutputParserException as e:
+        error = e
+
+    repaired = completion
+    for name, repair in REPAIRS:
+        attempt = repair(repaired)
+        if attempt == repaired:
+            continue
+        repaired = attempt
+
+        try:
+            parsed_completion = parser.parse(repaired)
+        except OutputParserException:
+            continue
+
+        repair_counts[name] += 1
+        return parsed_completion
+
+    raise error
+
+
+class RepairingOutputParser(BaseOutputParser[T]):
+    """Wraps a parser, trying cheap, local repairs of the completion before
+    asking the LLM to fix it.
+
+    The LLM round-trip goes through ChatModel, so it shares the response cache,
+    rate limiter, scheduler and circuit breaker with every other request. That
+    makes it async only, parse() just does the local repairs.
+    """
+
+    parser: BaseOutputParser[T]
+    # a ChatModel, which can't be imported here without a cycle
+    llm: Any
+    prompt: BasePromptTemplate = NAIVE_FIX_PROMPT
+
+    @classmethod
+    def from_llm(
+        cls,
+        llm: Any,
+        parser: BaseOutputParser[T],
+        prompt: BasePromptTemplate = NAIVE_FIX_PROMPT,
+    ) -> "RepairingOutputParser[T]":
+        return cls(parser=parser, llm=llm, prompt=prompt)
+
+    def parse(self, completion: str) -> T:
+        return repair_and_parse(self.parser, completion)
+
+    async def aparse(self, completion: str) -> T:
+        try:
+            return repair_and_parse(self.parser, completion)
+        except OutputParserException as e:
+            repair_counts["llm"] += 1
+            messages = self.prompt.format_prompt(
+                instructions=self.parser.get_format_instructions(),
+                completion=completion,
+                error=repr(e),
+            ).to_messages()
+            new_completion = await self.llm.get_chat_completion(
+                messages, prompt_type=PromptString.OUTPUT_FORMAT
+            )
+            return repair_and_parse(self.parser, new_completion)
+
+    def get_format_instructions(self) -> str:
+        return self.parser.get_format_instructions()
+
+    @property
+    def _type(self) -> str:
+        return self.parser._type
+
+
+def get_output_repair_counts() -> dict[str, int]:
+    return dict(repair_counts)
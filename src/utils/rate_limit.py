@@ -0,0 +1,227 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from .parameters import DEFAULT_RATE_LIMIT, MAX_CONCURRENT_REQUESTS, MODEL_RATE_LIMITS
+
+# Requests slower than this multiple of the average latency stop concurrency growing
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+
+# Provider errors worth retrying besides rate limits, matched by class name
+TRANSIENT_ERROR_NAMES = {
+    "Timeout",
+    "TimeoutError",
+    "APIError",
+    "APIConnectionError",
+    "ServiceUnavailableError",
+}
+RETRY_MIN_SECONDS = 1
+RETRY_MAX_SECONDS = 30
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return (
+        getattr(error, "http_status", None) == 429
+        or getattr(error, "status_code", None) == 429
+        or type(error).__name__ == "RateLimitError"
+        or "429" in message
+        or "rate limit" in message
+    )
+
+
+def is_retryable_error(error: Exception) -> bool:
+    return is_rate_limit_error(error) or type(error).__name__ in TRANSIENT_ERROR_NAMES
+
+
+def backoff_seconds(attempt: int) -> float:
+    """Exponential backoff with jitter, for the given zero-based attempt"""
+    delay = min(RETRY_MAX_SECONDS, RETRY_MIN_SECONDS * 2**attempt)
+    return delay * random.uniform(0.5, 1)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, good enough for pacing requests"""
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """Allows `per_minute` units per minute, refilling continuously."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(
+            self.capacity, self.available + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def wait_time(self, amount: int) -> float:
+        """Seconds until `amount` units are available"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: int) -> None:
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+    def drain(self) -> None:
+        self._refill()
+        self.available = min(self.available, 0.0)
+
+
+class RateLimiter:
+    """Paces the requests made to a single model across every agent.
+
+    Requests wait in FIFO order until both the requests-per-minute and
+    tokens-per-minute buckets allow them and a concurrency slot is free. The
+    number of slots adapts with AIMD: it grows by about one per round of
+    successful, normally-fast requests and halves whenever the provider answers
+    with a rate limit error.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: int,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+    ):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max(1, max_concurrency // 2))
+        self.in_flight = 0
+        self.waiters: deque[tuple[int, asyncio.Future]] = deque()
+        self.dispatch_handle: Optional[asyncio.TimerHandle] = None
+        self.average_latency: Optional[float] = None
+        self.rate_limited_count = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.waiters)
+
+    @property
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "concurrency": int(self.concurrency),
+            "average_latency": self.average_latency,
+            "rate_limited_count": self.rate_limited_count,
+        }
+
+    def _wait_time(self, tokens: int) -> float:
+        wait_time = self.requests.wait_time(1)
+        if self.tokens is not None:
+            wait_time = max(wait_time, self.tokens.wait_time(tokens))
+        return wait_time
+
+    def _schedule_dispatch(self, delay: float) -> None:
+        if self.dispatch_handle is None:
+            self.dispatch_handle = asyncio.get_running_loop().call_later(
+                delay, self._dispatch_later
+            )
+
+    def _dispatch_later(self) -> None:
+        self.dispatch_handle = None
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.waiters and self.in_flight < int(self.concurrency):
+            tokens, future = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+                continue
+
+            wait_time = self._wait_time(tokens)
+            if wait_time > 0:
+                self._schedule_dispatch(wait_time)
+                return
+
+            self.waiters.popleft()
+            self.requests.consume(1)
+            if self.tokens is not None:
+                self.tokens.consume(tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self, tokens: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((tokens, future))
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def record_success(self, latency: float) -> None:
+        if self.average_latency is None:
+            self.average_latency = latency
+        elif latency <= self.average_latency * LATENCY_TOLERANCE:
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1 / self.concurrency
+            )
+
+        self.average_latency += LATENCY_SMOOTHING * (latency - self.average_latency)
+
+    def record_rate_limited(self) -> None:
+        self.rate_limited_count += 1
+        self.concurrency = max(1.0, self.concurrency / 2)
+        # stop sending until the request bucket has refilled a little
+        self.requests.drain()
+
+    @asynccontextmanager
+    async def limit(self, tokens: int):
+        await self.acquire(tokens)
+        started_at = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.record_rate_limited()
+            raise
+        except GeneratorExit:
+            # a stream the caller closed early
+            self.record_success(time.monotonic() - started_at)
+            raise
+        else:
+            self.record_success(time.monotonic() - started_at)
+        finally:
+            self.release()
+
+
+rate_limiters: dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(model_name: str) -> RateLimiter:
+    if model_name not in rate_limiters:
+        requests_per_minute, tokens_per_minute = MODEL_RATE_LIMITS.get(
+            model_name, DEFAULT_RATE_LIMIT
+        )
+        rate_limiters[model_name] = RateLimiter(
+            model_name, requests_per_minute, tokens_per_minute
+        )
+    return rate_limiters[model_name]
+
+
+def get_rate_limiter_metrics() -> dict[str, dict]:
+    return {name: limiter.metrics for name, limiter in rate_limiters.items()}
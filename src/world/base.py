@@ -111,3 +111,6 @@ class World(BaseModel):
         concurrency = min(os.cpu_count(), len(self.agents))
         tasks = [self.run_agent_loop() for _ in range(concurrency)]
         await asyncio.gather(*tasks)
+
+    async def stop(self):
+        await asyncio.gather(*[agent.stop() for agent in self.agents])
@@ -1,5 +1,8 @@
+import asyncio
+from typing import Optional
 from uuid import UUID
 
+import numpy as np
 from pydantic import BaseModel
 
 from src.utils.database.base import Tables
@@ -7,6 +10,7 @@ from src.utils.database.client import get_database
 
 from ..event.base import Event, EventsManager
 from ..utils.colors import NUM_AGENT_COLORS, LogColor
+from ..utils.embeddings import get_embedding
 
 
 class WorldData(BaseModel):
@@ -66,12 +70,23 @@ class WorldContext(BaseModel):
         if event.agent_id not in event.witness_ids:
             event.witness_ids.append(event.agent_id)
 
-        # Add event to the db
+        # Embed the event once for all of its witnesses, while adding it to the db
+        async def embed() -> Optional[np.ndarray]:
+            try:
+                return await get_embedding(event.description)
+            except Exception:
+                # the witnesses embed their memories of it themselves instead
+                return None
+
+        embedding_task = asyncio.create_task(embed())
+
         database = await get_database()
         await database.insert(Tables.Events, event.db_dict())
 
-        # add event to local events list
-        self.events_manager.recent_events.append(event)
+        event.embedding = await embedding_task
+
+        # add event to local events buffer
+        self.events_manager.add_event(event)
 
         return event
 